@@ -2,12 +2,34 @@ from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
 
+from services.mongo_pool_metrics import mongo_pool_metrics
+from services.request_db_metrics import mongo_command_metrics
+
 load_dotenv()
 
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 db_name = os.environ.get('DB_NAME', 'automotive_agency')
 
-client = AsyncIOMotorClient(mongo_url)
+# Pool de conexiones (un solo cliente por proceso)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '50'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '5'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '30000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '5000'))
+
+# Motor no abre conexiones hasta la primera operación; el lifespan hace el
+# ping de arranque con `connect()` y cierra el pool con `close()`.
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    event_listeners=[mongo_pool_metrics, mongo_command_metrics],
+)
 db = client[db_name]
 
 # Collections
@@ -21,6 +43,20 @@ appointments_collection = db.appointments
 conversations_collection = db.conversations
 messages_collection = db.messages
 system_config_collection = db.system_config
+processed_messages_collection = db.processed_messages
+outbox_collection = db.outbox
+
+
+async def connect():
+    """
+    Ping de arranque: abre el pool y falla temprano si Mongo no responde.
+    """
+    await client.admin.command('ping')
+
+
+def close():
+    client.close()
+
 
 async def get_database():
     return db
@@ -208,6 +208,7 @@ class Message(BaseModel):
     from_customer: bool
     message_text: str
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    delivery_status: Optional[str] = None
 
 class Conversation(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -240,6 +241,7 @@ class SystemConfig(BaseModel):
     whatsapp_verify_token: Optional[str] = None
     gemini_api_key: Optional[str] = None
     ai_system_prompt: Optional[str] = None
+    message_debounce_ms: Optional[int] = None
     primary_color: str = "hsl(221.2 83.2% 53.3%)"
     secondary_color: str = "hsl(210 40% 96.1%)"
     button_color: str = "hsl(221.2 83.2% 53.3%)"
@@ -257,6 +259,7 @@ class SystemConfigUpdate(BaseModel):
     whatsapp_verify_token: Optional[str] = None
     gemini_api_key: Optional[str] = None
     ai_system_prompt: Optional[str] = None
+    message_debounce_ms: Optional[int] = Field(default=None, ge=0, le=10000)
     primary_color: Optional[str] = None
     secondary_color: Optional[str] = None
     button_color: Optional[str] = None
@@ -3,6 +3,8 @@ from typing import List
 from models import Agency, AgencyCreate
 from database import agencies_collection, system_config_collection
 from auth import get_current_user
+from services.agency_routing import agency_routing
+from services.agency_context import agency_context
 import uuid
 from datetime import datetime
 
@@ -51,6 +53,7 @@ Cuando hayas recopilado: nombre, teléfono y fecha/hora preferida, agenda la cit
         "updated_at": datetime.utcnow()
     }
     await system_config_collection.insert_one(config_dict)
+    agency_routing.invalidate()
     
     return Agency(**agency_dict)
 
@@ -74,6 +77,8 @@ async def update_agency(agency_id: str, agency_update: AgencyCreate, current_use
     
     update_dict = agency_update.model_dump()
     await agencies_collection.update_one({"id": agency_id}, {"$set": update_dict})
+    agency_routing.invalidate()
+    agency_context.invalidate(agency_id)
     
     updated = await agencies_collection.find_one({"id": agency_id}, {"_id": 0})
     return Agency(**updated)
@@ -85,6 +90,8 @@ async def delete_agency(agency_id: str, current_user: dict = Depends(get_current
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Agency not found")
 
+    agency_routing.invalidate()
+    agency_context.invalidate(agency_id)
     return {"message": "Agency deleted successfully"}
 
 
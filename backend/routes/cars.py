@@ -3,6 +3,7 @@ from typing import List, Optional
 from models import Car, CarCreate
 from database import cars_collection
 from auth import get_current_user
+from services.agency_context import agency_context
 import uuid
 from datetime import datetime
 
@@ -20,6 +21,7 @@ async def create_car(car: CarCreate, current_user: dict = Depends(get_current_us
     }
     
     await cars_collection.insert_one(car_dict)
+    agency_context.invalidate(car.agency_id)
     return Car(**car_dict)
 
 @router.get("/", response_model=List[Car])
@@ -55,20 +57,28 @@ async def update_car(car_id: str, car_update: CarCreate, current_user: dict = De
     
     update_dict = car_update.model_dump()
     await cars_collection.update_one({"id": car_id}, {"$set": update_dict})
+    agency_context.invalidate(existing.get("agency_id"))
+    agency_context.invalidate(car_update.agency_id)
     
     updated = await cars_collection.find_one({"id": car_id}, {"_id": 0})
     return Car(**updated)
 
 @router.delete("/{car_id}")
 async def delete_car(car_id: str, current_user: dict = Depends(get_current_user)):
-    result = await cars_collection.delete_one({"id": car_id})
-    if result.deleted_count == 0:
+    deleted = await cars_collection.find_one_and_delete({"id": car_id}, {"agency_id": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Car not found")
+    agency_context.invalidate(deleted.get("agency_id"))
     return {"message": "Car deleted successfully"}
 
 @router.patch("/{car_id}/availability")
 async def toggle_availability(car_id: str, is_available: bool, current_user: dict = Depends(get_current_user)):
-    result = await cars_collection.update_one({"id": car_id}, {"$set": {"is_available": is_available}})
-    if result.matched_count == 0:
+    updated = await cars_collection.find_one_and_update(
+        {"id": car_id},
+        {"$set": {"is_available": is_available}},
+        {"agency_id": 1}
+    )
+    if not updated:
         raise HTTPException(status_code=404, detail="Car not found")
+    agency_context.invalidate(updated.get("agency_id"))
     return {"message": "Availability updated"}
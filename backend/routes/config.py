@@ -2,6 +2,10 @@ from fastapi import APIRouter, HTTPException, Depends
 from models import SystemConfig, SystemConfigUpdate
 from database import system_config_collection
 from auth import get_current_user
+from services.agency_routing import agency_routing
+from services.whatsapp_client import whatsapp_client
+from services.agency_context import agency_context
+from services.gemini_clients import gemini_clients
 from datetime import datetime
 
 router = APIRouter(prefix="/api/config", tags=["config"])
@@ -46,6 +50,9 @@ async def update_config(
         }
 
         await system_config_collection.insert_one(base_config)
+        agency_routing.invalidate()
+        whatsapp_client.invalidate(agency_id)
+        agency_context.invalidate(agency_id)
         return SystemConfig(**base_config)
 
     update_dict = {
@@ -54,10 +61,16 @@ async def update_config(
     }
     update_dict["updated_at"] = datetime.utcnow()
 
+    if "gemini_api_key" in update_dict and update_dict["gemini_api_key"] != existing.get("gemini_api_key"):
+        gemini_clients.evict(existing.get("gemini_api_key"))
+
     await system_config_collection.update_one(
         {"agency_id": agency_id},
         {"$set": update_dict}
     )
+    agency_routing.invalidate()
+    whatsapp_client.invalidate(agency_id)
+    agency_context.invalidate(agency_id)
 
     updated = await system_config_collection.find_one(
         {"agency_id": agency_id},
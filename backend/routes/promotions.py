@@ -4,6 +4,7 @@ from datetime import datetime, timezone
 from bson import ObjectId
 from database import media_files_collection
 from auth import get_current_user
+from services.agency_context import agency_context
 from models import MediaFile, PromotionUpdate
 
 router = APIRouter(prefix="/api/promotions", tags=["promotions"])
@@ -70,6 +71,7 @@ async def update_promotion(
     if not result:
         raise HTTPException(status_code=404, detail="Promotion not found")
 
+    agency_context.invalidate(result.get("agency_id"))
     return MediaFile(**result)
 
 
@@ -117,6 +119,7 @@ async def toggle_promotion(
         {"id": file_id},
         {"$set": {"is_active": is_active}}
     )
+    agency_context.invalidate(promotion.get("agency_id"))
 
     return {
         "message": "Promotion status updated",
@@ -1,8 +1,11 @@
 # routes/test_chat.py
 
+import json
+
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from services.chat_engine import handle_chat_message
+from services.chat_engine import handle_chat_message, stream_chat_message
 
 router = APIRouter(prefix="/api/test-chat", tags=["test-chat"])
 
@@ -25,3 +28,31 @@ async def test_chat(payload: TestChatPayload):
         "response": response,
         "conversation_id": conversation_id
     }
+
+
+@router.post("/stream")
+async def test_chat_stream(payload: TestChatPayload):
+    """
+    Igual que POST /api/test-chat, pero manda los tokens como Server-Sent
+    Events: eventos `token` mientras el modelo genera y un evento `done`
+    con la respuesta final.
+    """
+    async def event_stream():
+        try:
+            async for event in stream_chat_message(
+                agency_id=payload.agency_id,
+                customer_identifier=payload.conversation_id or "test-user",
+                message_text=payload.message,
+                is_test=True
+            ):
+                name = "done" if event.get("done") else "token"
+                yield f"event: {name}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            print(f"Error streaming test chat: {e}")
+            yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
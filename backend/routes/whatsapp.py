@@ -1,19 +1,13 @@
 from fastapi import APIRouter, HTTPException, Depends, Request, Query
-from database import (
-    system_config_collection,
-    conversations_collection,
-    messages_collection,
-    customers_collection,
-    cars_collection,
-    promotions_collection,
-    agencies_collection,
-    appointments_collection)
+from database import appointments_collection
 from auth import get_current_user
-import httpx
 import uuid
 import asyncio
 import re
-from datetime import datetime, timedelta
+import time
+from functools import partial
+from datetime import datetime
+from typing import AsyncIterator
 from dateutil import parser as date_parser
 import os
 from models import LeadSource
@@ -21,11 +15,27 @@ from models import LeadSource
 
 # esto es  la citas con IA
 from services.ai_service import handle_ai_action
+from services.webhook_queue import WebhookQueueFull, webhook_pool
+from services.message_dedup import message_dedup
+from services.agency_routing import agency_routing
+from services.whatsapp_client import whatsapp_client
+from services.outbox import enqueue_outbound, outbox_dispatcher
+from services.message_coalescer import message_coalescer
+from services.agency_context import agency_context
+from services.gemini_clients import GeminiOverloadedError, gemini_clients
+from services.response_cache import response_cache
+from services.inventory_search import build_inventory_context
+from services.circuit_breaker import HEDGE_MODE, gemini_breaker
+from services.intent_matcher import intent_matcher
+from services.datetime_extraction import DEFAULT_APPOINTMENT_TIME, extract_datetime
+from services.recent_messages import get_recent_messages
+from services.conversation_state_service import state_cache_stats
+from services.conversation_locks import conversation_locks, conversation_key
+from services.message_pipeline import MessagePipeline, MessageTurn, load_agency_context, pipeline_metrics
+from services.message_writer import message_writer
+from services.mongo_pool_metrics import mongo_pool_metrics
 from pydantic import BaseModel
 
-# Import Google Generative AI directly (replaces emergentintegrations)
-from google import genai
-
 # estructura de JSON
 import json
 
@@ -33,146 +43,69 @@ router = APIRouter(prefix="/api/whatsapp", tags=["whatsapp"])
 
 DEFAULT_VERIFY_TOKEN = "Ventas123"
 
-DAYS_MAP = {
-    'lunes': 0, 'martes': 1, 'miércoles': 2, 'miercoles': 2,
-    'jueves': 3, 'viernes': 4, 'sábado': 5, 'sabado': 5, 'domingo': 6
-}
+TIME_NUMBER_RE = re.compile(r'\d{1,2}(?::\d{2})?\s*(?:am|pm|hrs?)?')
 
-MONTHS_MAP = {
-    'enero': 1,
-    'febrero': 2,
-    'marzo': 3,
-    'abril': 4,
-    'mayo': 5,
-    'junio': 6,
-    'julio': 7,
-    'agosto': 8,
-    'septiembre': 9,
-    'octubre': 10,
-    'noviembre': 11,
-    'diciembre': 12}
-
-
-async def detect_and_create_appointment(
-        agency_id: str,
-        customer_id: str,
-        user_message: str,
-        conversation_id: str) -> dict:
+
+def detect_appointment_datetime(user_message: str) -> datetime | None:
+    """
+    Fecha y hora de la cita si el mensaje pide una visita con fecha; sin
+    tocar la base de datos.
+    """
     message_lower = user_message.lower()
-    appointment_keywords = [
-        'cita',
-        'agendar',
-        'reservar',
-        'apartar',
-        'ir',
-        'visitar',
-        'voy',
-        'iré',
-        'ire',
-        'paso',
-        'llego']
-    time_keywords = [
-        'hora',
-        'mañana',
-        'tarde',
-        'lunes',
-        'martes',
-        'miércoles',
-        'jueves',
-        'viernes',
-        'sábado',
-        'domingo']
-
-    has_appointment_intent = any(
-        kw in message_lower for kw in appointment_keywords)
-    has_time_reference = any(
-        kw in message_lower for kw in time_keywords) or re.search(
-        r'\d{1,2}(?::\d{2})?\s*(?:am|pm|hrs?)?', message_lower)
+    intents = intent_matcher.classify(message_lower)
+
+    has_appointment_intent = "visit" in intents
+    has_time_reference = "time_reference" in intents or TIME_NUMBER_RE.search(message_lower)
 
     if not (has_appointment_intent and has_time_reference):
         return None
 
-    appointment_date = None
-    appointment_time = None
-    now = datetime.utcnow()
-
-    if 'mañana' in message_lower and 'pasado' not in message_lower:
-        appointment_date = now + timedelta(days=1)
-    elif 'pasado mañana' in message_lower:
-        appointment_date = now + timedelta(days=2)
-    elif 'hoy' in message_lower:
-        appointment_date = now
-
-    for day_name, day_num in DAYS_MAP.items():
-        if day_name in message_lower:
-            days_ahead = day_num - now.weekday()
-            if days_ahead <= 0:
-                days_ahead += 7
-            appointment_date = now + timedelta(days=days_ahead)
-            break
-
-    date_match = re.search(
-        r'(\d{1,2})\s*(?:de\s+)?(enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre)',
-        message_lower)
-    if date_match:
-        day = int(date_match.group(1))
-        month = MONTHS_MAP.get(date_match.group(2), now.month)
-        year = now.year if month >= now.month else now.year + 1
-        try:
-            appointment_date = datetime(year, month, day)
-        except ValueError:
-            pass
-
-    time_match = re.search(
-        r'(\d{1,2})(?::(\d{2}))?\s*(am|pm|hrs?|horas?)?',
-        message_lower)
-    if time_match:
-        hour = int(time_match.group(1))
-        minute = int(time_match.group(2)) if time_match.group(2) else 0
-        period = time_match.group(3) or ''
-        if 'pm' in period.lower() and hour < 12:
-            hour += 12
-        elif 'am' in period.lower() and hour == 12:
-            hour = 0
-        if hour < 9 and not period:
-            hour += 12
-        appointment_time = f"{hour:02d}:{minute:02d}"
-
-    if appointment_date and not appointment_time:
-        appointment_time = "10:00"
-
-    if appointment_date:
-        try:
-            if appointment_time:
-                hour, minute = map(int, appointment_time.split(':'))
-                appointment_datetime = appointment_date.replace(
-                    hour=hour, minute=minute, second=0, microsecond=0)
-            else:
-                appointment_datetime = appointment_date.replace(
-                    hour=10, minute=0, second=0, microsecond=0)
-
-            appointment_id = str(uuid.uuid4())
-            appointment_data = {
-                "id": appointment_id,
-                "customer_id": customer_id,
-                "agency_id": agency_id,
-                "appointment_date": appointment_datetime,
-                "status": "pending",
-                "source": LeadSource.WHATSAPP,
-                "notes": f"Cita agendada automáticamente por IA. Mensaje: {user_message[:100]}",
-                "created_at": datetime.utcnow()}
-            await appointments_collection.insert_one(appointment_data)
-            return {
-                "created": True,
-                "appointment_id": appointment_id,
-                "date": appointment_datetime.strftime("%d/%m/%Y"),
-                "time": appointment_datetime.strftime("%H:%M"),
-                "datetime": appointment_datetime
-            }
-        except Exception as e:
-            print(f"Error creating appointment: {e}")
-            return None
-    return None
+    appointment_date, appointment_time = extract_datetime(message_lower)
+    if not appointment_date:
+        return None
+    return datetime.combine(appointment_date, appointment_time or DEFAULT_APPOINTMENT_TIME)
+
+
+async def create_detected_appointment(
+        agency_id: str,
+        customer_id: str,
+        user_message: str,
+        appointment_datetime: datetime) -> dict | None:
+    try:
+        appointment_id = str(uuid.uuid4())
+        appointment_data = {
+            "id": appointment_id,
+            "customer_id": customer_id,
+            "agency_id": agency_id,
+            "appointment_date": appointment_datetime,
+            "status": "pending",
+            "source": LeadSource.WHATSAPP,
+            "notes": f"Cita agendada automáticamente por IA. Mensaje: {user_message[:100]}",
+            "created_at": datetime.utcnow()}
+        await appointments_collection.insert_one(appointment_data)
+        return {
+            "created": True,
+            "appointment_id": appointment_id,
+            "date": appointment_datetime.strftime("%d/%m/%Y"),
+            "time": appointment_datetime.strftime("%H:%M"),
+            "datetime": appointment_datetime
+        }
+    except Exception as e:
+        print(f"Error creating appointment: {e}")
+        return None
+
+
+async def detect_and_create_appointment(turn: MessageTurn) -> dict | None:
+    """
+    Detecta la cita en paralelo con el guardado del mensaje entrante, pero
+    solo la inserta cuando el mensaje ya quedó guardado.
+    """
+    appointment_datetime = detect_appointment_datetime(turn.message_text)
+    if not appointment_datetime:
+        return None
+    await turn.inbound_saved.wait()
+    return await create_detected_appointment(
+        turn.agency_id, turn.customer_id, turn.message_text, appointment_datetime)
 
 
 @router.api_route("/webhook", methods=["GET", "HEAD"])
@@ -198,6 +131,11 @@ async def verify_webhook(
 
 @router.post("/webhook")
 async def receive_whatsapp_message(request: Request):
+    """
+    Responde 200 de inmediato y deja el procesamiento al pool de workers.
+    Si la cola está llena responde 503 para que Meta reintente la entrega.
+    """
+    from fastapi.responses import JSONResponse
     try:
         data = await request.json()
         if "entry" not in data:
@@ -206,92 +144,156 @@ async def receive_whatsapp_message(request: Request):
             for change in entry.get("changes", []):
                 value = change.get("value", {})
                 messages = value.get("messages", [])
+                phone_number_id = value.get("metadata", {}).get("phone_number_id")
                 for message in messages:
                     from_phone = message.get("from")
                     message_text = message.get("text", {}).get("body", "")
                     message_id = message.get("id")
                     if not from_phone or not message_text:
                         continue
-                    agency = await agencies_collection.find_one({"is_active": True}, {"_id": 0})
-                    if not agency:
-                        agency = await agencies_collection.find_one({}, {"_id": 0})
-                    if not agency:
+                    if not message_dedup.remember(message_id):
                         continue
-                    agency_id = agency["id"]
-                    await process_incoming_message(agency_id, from_phone, message_text, message_id)
+                    try:
+                        await webhook_pool.submit(
+                            f"{phone_number_id}:{from_phone}",
+                            partial(
+                                handle_webhook_message,
+                                phone_number_id,
+                                from_phone,
+                                message_text,
+                                message_id)
+                        )
+                    except WebhookQueueFull:
+                        # Los mensajes ya encolados se descartan en la reentrega
+                        message_dedup.forget(message_id)
+                        return JSONResponse(
+                            status_code=503,
+                            content={"status": "busy"})
         return {"status": "ok"}
     except Exception as e:
         print(f"Error processing webhook: {e}")
         return {"status": "error", "message": str(e)}
 
 
+async def handle_webhook_message(
+        phone_number_id: str | None,
+        from_phone: str,
+        message_text: str,
+        message_id: str):
+    if not await message_dedup.claim(message_id):
+        return
+    try:
+        await _handle_claimed_message(phone_number_id, from_phone, message_text, message_id)
+    except Exception:
+        await message_dedup.release(message_id)
+        raise
+
+
+async def _handle_claimed_message(
+        phone_number_id: str | None,
+        from_phone: str,
+        message_text: str,
+        message_id: str):
+    agency_id = await agency_routing.resolve(phone_number_id)
+    if not agency_id:
+        return
+
+    debounce_ms = await agency_routing.debounce_ms(agency_id)
+    if debounce_ms <= 0:
+        await process_incoming_message(agency_id, from_phone, message_text, message_id)
+        return
+
+    # Se guarda cada mensaje, pero la respuesta se genera una vez por ráfaga
+    lock_key = conversation_key(agency_id, from_phone)
+    async with conversation_locks.hold(lock_key):
+        turn = await whatsapp_pipeline.receive(_whatsapp_turn(agency_id, from_phone, message_text))
+    ordering_key = f"{phone_number_id}:{from_phone}"
+
+    async def reply_burst(merged_text: str):
+        async with conversation_locks.hold(lock_key):
+            await whatsapp_pipeline.respond(turn.follow_up(merged_text))
+
+    async def flush_burst(merged_text: str):
+        try:
+            await webhook_pool.submit(ordering_key, partial(reply_burst, merged_text))
+        except WebhookQueueFull:
+            # Los mensajes ya están guardados; se responde desde el coalescer
+            await reply_burst(merged_text)
+
+    message_coalescer.add(turn.conversation_id, message_text, debounce_ms, flush_burst)
+
+
+@router.get("/queue/stats")
+async def get_queue_stats(current_user: dict = Depends(get_current_user)):
+    return {
+        **webhook_pool.stats(),
+        "dedup": message_dedup.stats(),
+        "routing": agency_routing.stats(),
+        "outbox": await outbox_dispatcher.stats(),
+        "coalescer": message_coalescer.stats(),
+        "agency_context": agency_context.stats(),
+        "gemini_clients": gemini_clients.stats(),
+        "response_cache": response_cache.stats(),
+        "gemini_breaker": gemini_breaker.stats(),
+        "conversation_state": state_cache_stats(),
+        "conversation_locks": conversation_locks.stats(),
+        "message_writer": message_writer.stats(),
+        "pipeline": pipeline_metrics.stats(),
+        "mongo_pool": mongo_pool_metrics.stats()
+    }
+
+
 async def process_incoming_message(
         agency_id: str,
         from_phone: str,
         message_text: str,
         message_id: str):
-    customer = await customers_collection.find_one({"phone": from_phone, "agency_id": agency_id})
-    if not customer:
-        customer_id = str(uuid.uuid4())
-        customer = {
-            "id": customer_id,
-            "agency_id": agency_id,
-            "name": from_phone,
-            "phone": from_phone,
-            "source": LeadSource.WHATSAPP,
-            "created_at": datetime.utcnow()}
-        await customers_collection.insert_one(customer)
-    else:
-        customer_id = customer["id"]
-
-    conversation = await conversations_collection.find_one({"agency_id": agency_id, "customer_id": customer_id})
-    if not conversation:
-        conversation_id = str(uuid.uuid4())
-        conversation = {
-            "id": conversation_id,
-            "agency_id": agency_id,
-            "customer_id": customer_id,
-            "whatsapp_phone": from_phone,
-            "last_message": message_text,
-            "last_message_at": datetime.utcnow(),
-            "created_at": datetime.utcnow()}
-        await conversations_collection.insert_one(conversation)
-    else:
-        conversation_id = conversation["id"]
-        await conversations_collection.update_one({"id": conversation_id}, {"$set": {"last_message": message_text, "last_message_at": datetime.utcnow()}})
-
-    incoming_msg = {
-        "id": str(
-            uuid.uuid4()),
-        "conversation_id": conversation_id,
-        "from_customer": True,
-        "message_text": message_text,
-        "timestamp": datetime.utcnow()}
-    await messages_collection.insert_one(incoming_msg)
-
-    appointment_info = await detect_and_create_appointment(agency_id, customer_id, message_text, conversation_id)
-
-    if appointment_info and appointment_info.get("created"):
-        response_text = f"✅ ¡Excelente! He agendado tu cita:\n\n📅 Fecha: {appointment_info['date']}\n🕐 Hora: {appointment_info['time']}\n\n"
-        agency = await agencies_collection.find_one({"id": agency_id}, {"_id": 0})
-        if agency:
-            if agency.get('address'):
-                response_text += f"📍 Dirección: {agency['address']}\n"
-            if agency.get('phone'):
-                response_text += f"📞 Teléfono: {agency['phone']}\n"
-        response_text += "\n¡Te esperamos!"
-    else:
-        response_text = await generate_ai_response(agency_id, conversation_id, message_text)
-
-    outgoing_msg = {
-        "id": str(
-            uuid.uuid4()),
-        "conversation_id": conversation_id,
-        "from_customer": False,
-        "message_text": response_text,
-        "timestamp": datetime.utcnow()}
-    await messages_collection.insert_one(outgoing_msg)
-    await send_whatsapp_message(agency_id, from_phone, response_text)
+    async with conversation_locks.hold(conversation_key(agency_id, from_phone)):
+        await whatsapp_pipeline.run(_whatsapp_turn(agency_id, from_phone, message_text))
+
+
+def _whatsapp_turn(agency_id: str, from_phone: str, message_text: str) -> MessageTurn:
+    return MessageTurn(
+        agency_id=agency_id,
+        channel="whatsapp",
+        message_text=message_text,
+        phone=from_phone,
+        source=LeadSource.WHATSAPP,
+        customer_name=from_phone,
+        whatsapp_phone=from_phone)
+
+
+async def _whatsapp_reply(turn: MessageTurn) -> str:
+    appointment_info = turn.intent
+    if not (appointment_info and appointment_info.get("created")):
+        return await generate_ai_response(turn.agency_id, turn.conversation_id, turn.message_text, turn.history)
+
+    response_text = f"✅ ¡Excelente! He agendado tu cita:\n\n📅 Fecha: {appointment_info['date']}\n🕐 Hora: {appointment_info['time']}\n\n"
+    agency = (await agency_context.get(turn.agency_id)).agency
+    if agency:
+        if agency.get('address'):
+            response_text += f"📍 Dirección: {agency['address']}\n"
+        if agency.get('phone'):
+            response_text += f"📞 Teléfono: {agency['phone']}\n"
+    response_text += "\n¡Te esperamos!"
+    return response_text
+
+
+async def _whatsapp_send(turn: MessageTurn):
+    await enqueue_outbound(
+        agency_id=turn.agency_id,
+        to_phone=turn.phone,
+        message_text=turn.response_text,
+        message_id=turn.outgoing["id"])
+
+
+# El envío real a la Graph API lo hace el outbox; aquí se mide el encolado
+whatsapp_pipeline = MessagePipeline(
+    detect_intent=detect_and_create_appointment,
+    generate_reply=_whatsapp_reply,
+    send=_whatsapp_send,
+    prefetch=load_agency_context,
+    touch_last_message=False)
 
 
 async def generate_fallback_response(
@@ -299,26 +301,13 @@ async def generate_fallback_response(
         cars: list,
         promotions: list,
         agency: dict) -> str:
-    message_lower = user_message.lower()
+    intents = intent_matcher.classify(user_message)
     agency_name = agency.get(
         'name', 'nuestra agencia') if agency else 'nuestra agencia'
 
-    if any(
-        word in message_lower for word in [
-            'hola',
-            'buenos',
-            'buenas',
-            'hi',
-            'hey']):
+    if "greeting" in intents:
         return f"¡Hola! Bienvenido a {agency_name}. ¿Te gustaría conocer nuestros autos disponibles, promociones, o agendar una cita?"
-    if any(
-        word in message_lower for word in [
-            'auto',
-            'autos',
-            'carro',
-            'carros',
-            'vehículo',
-            'vehiculo']):
+    if "cars" in intents:
         if cars:
             response = f"Tenemos {len(cars)} vehículos disponibles:\n\n"
             for car in cars[:5]:
@@ -329,33 +318,18 @@ async def generate_fallback_response(
             response += "\n¿Te gustaría agendar una cita para verlos?"
             return response
         return "Estamos actualizando nuestro inventario. ¿Te gustaría que un asesor te contacte?"
-    if any(
-        word in message_lower for word in [
-            'promoción',
-            'promocion',
-            'oferta',
-            'descuento']):
+    if "promotions" in intents:
         if promotions:
             response = "¡Promociones especiales!\n\n"
             for promo in promotions[:3]:
                 response += f"🎉 {promo.get('title', '')}: {promo.get('description', '')}\n\n"
             return response
         return "No tenemos promociones activas ahora. ¿Puedo ayudarte a encontrar un auto?"
-    if any(word in message_lower for word in ['cita', 'agendar', 'visitar']):
+    if "appointment" in intents:
         return "¡Excelente! ¿Qué día y hora te funcionaría para visitarnos?"
-    if any(
-        word in message_lower for word in [
-            'precio',
-            'costo',
-            'cuanto',
-            'financiamiento']):
+    if "pricing" in intents or "financing" in intents:
         return "Tenemos precios competitivos y opciones de financiamiento. ¿Qué modelo te interesa?"
-    if any(
-        word in message_lower for word in [
-            'horario',
-            'ubicación',
-            'direccion',
-            'donde']):
+    if "location" in intents or "hours" in intents:
         response = "Nuestra información:\n\n"
         if agency:
             if agency.get('address'):
@@ -365,124 +339,277 @@ async def generate_fallback_response(
             if agency.get('business_hours'):
                 response += f"🕐 {agency['business_hours']}\n"
         return response
-    if any(
-        word in message_lower for word in [
-            'gracias',
-            'ok',
-            'vale',
-            'perfecto']):
+    if "thanks" in intents:
         return "¡Con gusto! ¿Algo más en que pueda ayudarte? 🚗"
     return f"Gracias por contactar a {agency_name}. Puedo ayudarte con:\n• Autos disponibles\n• Promociones\n• Agendar cita\n• Ubicación\n\n¿Qué necesitas?"
 
 
+GEMINI_MODEL = "models/gemini-2.5-flash"
+GEMINI_CONFIG = {
+    "temperature": 0.7,
+    "max_output_tokens": 1024
+}
+AI_TIMEOUT = 30.0
+
+
+def _usable_api_key(config: dict) -> str | None:
+    api_key = config.get("gemini_api_key", "")
+    # EMERGENT_LLM_KEY only works inside Emergent platform - use fallback
+    # outside
+    if not api_key or api_key == "EMERGENT_LLM_KEY" or "emergent" in api_key.lower():
+        return None
+    return api_key
+
+
+async def build_ai_prompt(
+        snapshot,
+        conversation_id: str,
+        user_message: str,
+        history: list | None = None) -> str:
+    config = snapshot.config
+    agency = snapshot.agency
+    promotions = snapshot.current_promotions()
+
+    system_prompt = config.get(
+        "ai_system_prompt",
+        "Eres un asistente de ventas automotriz.")
+    conv_messages = history if history is not None else await get_recent_messages(conversation_id)
+
+    context = f"""{system_prompt}
+
+Agencia: {agency.get('name', '')}
+Dirección: {agency.get('address', '')}
+Teléfono: {agency.get('phone', '')}
+
+Autos disponibles ({len(snapshot.cars)} en inventario, se listan los más relevantes):"""
+    context += build_inventory_context(snapshot.inventory, user_message)
+
+    if promotions:
+        context += "\n\nPromociones:"
+        for promo in promotions:
+            context += f"\n- {promo['title']}: {promo['description']}"
+
+    context += "\n\nResponde profesionalmente en español. Orienta al cliente a agendar cita."
+
+    history_text = ""
+    for msg in conv_messages[-5:]:
+        role = "Cliente" if msg.get('from_customer') else "Asistente"
+        history_text += f"{role}: {msg.get('message_text', '')}\n"
+
+    return f"{context}\n\nHistorial:\n{history_text}\nCliente: {user_message}\n\nAsistente:"
+
+
+def _cache_ai_response(snapshot, user_message: str, history: list | None, text: str):
+    # Las respuestas con acciones (JSON) dependen del cliente, no se cachean
+    if text and '"action"' not in text:
+        response_cache.set(snapshot.agency_id, snapshot.version, user_message, history, text)
+
+
+async def _fallback_for(agency_id: str, user_message: str, snapshot=None) -> str:
+    try:
+        snapshot = snapshot or await agency_context.get(agency_id)
+        return await generate_fallback_response(
+            user_message, snapshot.cars, snapshot.promotions, snapshot.agency)
+    except BaseException:
+        return "Gracias por tu mensaje. Un asesor te contactará pronto."
+
+
+async def _generate_and_cache(snapshot, api_key: str, user_message: str, history: list | None, full_prompt: str):
+    """
+    Llama al modelo registrando latencia y resultado en el circuit breaker.
+    Si la respuesta llega tarde (después del hedging) igual queda en cache.
+    Si la llamada no consigue lugar (`GeminiOverloadedError`) o se cancela no
+    cuenta como falla del modelo.
+    """
+    started = time.perf_counter()
+    try:
+        response = await gemini_clients.generate_content(
+            api_key,
+            model=GEMINI_MODEL,
+            contents=full_prompt,
+            config=GEMINI_CONFIG,
+            timeout=AI_TIMEOUT
+        )
+    except GeminiOverloadedError:
+        gemini_breaker.release(api_key)
+        raise
+    except Exception:
+        gemini_breaker.record(api_key, time.perf_counter() - started, False)
+        raise
+    gemini_breaker.record(api_key, time.perf_counter() - started, True)
+    _cache_ai_response(snapshot, user_message, history, response.text)
+    return response
+
+
+def _discard_late_result(task: asyncio.Task):
+    _hedged_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"Error AI response (hedged): {task.exception()}")
+
+
+# Llamadas que siguen corriendo después de responder con el fallback
+_hedged_tasks: set[asyncio.Task] = set()
+
+
+async def _race_duplicate(first: asyncio.Task, snapshot, api_key: str, user_message: str,
+                          history: list | None, full_prompt: str):
+    """
+    `HEDGE_MODE="duplicate"`: lanza una segunda llamada igual y usa la que
+    termine primero; la otra se cancela.
+    """
+    pending = {first, asyncio.create_task(
+        _generate_and_cache(snapshot, api_key, user_message, history, full_prompt)
+    )}
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            # Si falló y la otra sigue corriendo se espera a la otra
+            if not pending:
+                return done.pop().result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
 async def generate_ai_response(
         agency_id: str,
         conversation_id: str,
-        user_message: str) -> str:
+        user_message: str,
+        history: list | None = None) -> str:
+    snapshot = None
     try:
-        config = await system_config_collection.find_one({"agency_id": agency_id})
+        snapshot = await agency_context.get(agency_id)
+        config = snapshot.config
         if not config:
             return "Lo siento, no puedo procesar tu mensaje ahora."
 
-        cars = await cars_collection.find({"agency_id": agency_id, "is_available": True}, {"_id": 0}).to_list(100)
-        now = datetime.utcnow()
-        promotions = await promotions_collection.find({"agency_id": agency_id, "is_active": True, "start_date": {"$lte": now}, "end_date": {"$gte": now}}, {"_id": 0}).to_list(100)
-        agency = await agencies_collection.find_one({"id": agency_id}, {"_id": 0})
+        api_key = _usable_api_key(config)
+        if not api_key:
+            return await generate_fallback_response(
+                user_message, snapshot.cars, snapshot.current_promotions(), snapshot.agency)
 
-        api_key = config.get("gemini_api_key", "")
-        # EMERGENT_LLM_KEY only works inside Emergent platform - use fallback
-        # outside
-        if not api_key or api_key == "EMERGENT_LLM_KEY" or "emergent" in api_key.lower():
-            return await generate_fallback_response(user_message, cars, promotions, agency)
+        cached = response_cache.get(agency_id, snapshot.version, user_message, history)
+        if cached:
+            return cached
 
-        system_prompt = config.get(
-            "ai_system_prompt",
-            "Eres un asistente de ventas automotriz.")
-        conv_messages = await messages_collection.find({"conversation_id": conversation_id}, {"_id": 0}).sort("timestamp", -1).limit(10).to_list(10)
-        conv_messages.reverse()
+        # Breaker abierto: ni siquiera se arma el prompt
+        if not gemini_breaker.allow(api_key):
+            return await generate_fallback_response(
+                user_message, snapshot.cars, snapshot.current_promotions(), snapshot.agency)
 
-        context = f"""{system_prompt}
+        try:
+            full_prompt = await build_ai_prompt(snapshot, conversation_id, user_message, history)
+        except BaseException:
+            gemini_breaker.release(api_key)
+            raise
 
-Agencia: {agency.get('name', '')}
-Dirección: {agency.get('address', '')}
-Teléfono: {agency.get('phone', '')}
+        # === MIGRACIÓN GEMINI SDK (google.genai) ===
+        task = asyncio.create_task(
+            _generate_and_cache(snapshot, api_key, user_message, history, full_prompt)
+        )
+        done, _ = await asyncio.wait({task}, timeout=gemini_breaker.hedge_timeout(api_key))
+        if done:
+            return task.result().text
 
-Autos disponibles:"""
-        for car in cars[:10]:
-            context += f"\n- {car.get('brand', '')} {car.get('model', '')} {car.get('year', '')}"
-            if car.get('price'):
-                context += f" - ${car['price']:,.2f}"
+        # Más lento que el percentil configurado
+        gemini_breaker.mark_hedged(api_key)
+        if HEDGE_MODE == "duplicate":
+            response = await _race_duplicate(task, snapshot, api_key, user_message, history, full_prompt)
+            return response.text
 
-        if promotions:
-            context += "\n\nPromociones:"
-            for promo in promotions:
-                context += f"\n- {promo['title']}: {promo['description']}"
+        _hedged_tasks.add(task)
+        task.add_done_callback(_discard_late_result)
+        return await generate_fallback_response(
+            user_message, snapshot.cars, snapshot.current_promotions(), snapshot.agency)
 
-        context += "\n\nResponde profesionalmente en español. Orienta al cliente a agendar cita."
+    except Exception as e:
+        print(f"Error AI response: {e}")
+        return await _fallback_for(agency_id, user_message, snapshot)
 
-        history_text = ""
-        for msg in conv_messages[-5:]:
-            role = "Cliente" if msg.get('from_customer') else "Asistente"
-            history_text += f"{role}: {msg.get('message_text', '')}\n"
 
-        full_prompt = f"{context}\n\nHistorial:\n{history_text}\nCliente: {user_message}\n\nAsistente:"
+async def stream_ai_response(
+        agency_id: str,
+        conversation_id: str,
+        user_message: str,
+        history: list | None = None) -> AsyncIterator[str]:
+    """
+    Igual que `generate_ai_response`, pero entrega el texto por partes
+    conforme el modelo lo genera.
+    """
+    snapshot = None
+    streamed = []
+    try:
+        snapshot = await agency_context.get(agency_id)
+        config = snapshot.config
+        if not config:
+            yield "Lo siento, no puedo procesar tu mensaje ahora."
+            return
 
-        # === MIGRACIÓN GEMINI SDK (google.genai) ===
-        client = genai.Client(api_key=api_key)
+        api_key = _usable_api_key(config)
+        if not api_key:
+            yield await generate_fallback_response(
+                user_message, snapshot.cars, snapshot.current_promotions(), snapshot.agency)
+            return
 
-        response = await asyncio.wait_for(
-            asyncio.to_thread(
-                client.models.generate_content,
-                model="models/gemini-2.5-flash",
+        cached = response_cache.get(agency_id, snapshot.version, user_message, history)
+        if cached:
+            yield cached
+            return
+
+        if not gemini_breaker.allow(api_key):
+            yield await generate_fallback_response(
+                user_message, snapshot.cars, snapshot.current_promotions(), snapshot.agency)
+            return
+
+        try:
+            full_prompt = await build_ai_prompt(snapshot, conversation_id, user_message, history)
+        except BaseException:
+            gemini_breaker.release(api_key)
+            raise
+
+        started = time.perf_counter()
+        ok = False
+        overloaded = False
+        try:
+            async for chunk in gemini_clients.generate_content_stream(
+                api_key,
+                model=GEMINI_MODEL,
                 contents=full_prompt,
-                config={
-                    "temperature": 0.7,
-                    "max_output_tokens": 1024
-                }
-            ),
-            timeout=30.0
-        )
+                config=GEMINI_CONFIG,
+                timeout=AI_TIMEOUT
+            ):
+                if chunk.text:
+                    streamed.append(chunk.text)
+                    yield chunk.text
+            ok = True
+        except GeminiOverloadedError:
+            overloaded = True
+            raise
+        finally:
+            if overloaded:
+                gemini_breaker.release(api_key)
+            else:
+                gemini_breaker.record(api_key, time.perf_counter() - started, ok)
 
-        return response.text
+        _cache_ai_response(snapshot, user_message, history, "".join(streamed))
 
     except Exception as e:
         print(f"Error AI response: {e}")
-        try:
-            cars = await cars_collection.find(
-                {"agency_id": agency_id, "is_available": True},
-                {"_id": 0}
-            ).to_list(100)
-            agency = await agencies_collection.find_one({"id": agency_id}, {"_id": 0})
-            promotions = await promotions_collection.find(
-                {"agency_id": agency_id, "is_active": True},
-                {"_id": 0}
-            ).to_list(100)
-            return await generate_fallback_response(user_message, cars, promotions, agency)
-        except BaseException:
-            return "Gracias por tu mensaje. Un asesor te contactará pronto."
+        # Si ya se mandó texto no se mezcla con el fallback
+        if not streamed:
+            yield await _fallback_for(agency_id, user_message, snapshot)
 
 
 async def send_whatsapp_message(agency_id: str, to_phone: str, message: str):
     try:
-        config = await system_config_collection.find_one({"agency_id": agency_id})
-        if not config:
-            return
-        access_token = config.get("whatsapp_access_token")
-        phone_number_id = config.get("whatsapp_phone_number_id")
-        if not access_token or not phone_number_id:
+        credentials = await whatsapp_client.get_credentials(agency_id)
+        if not credentials:
             return
-        url = f"https://graph.facebook.com/v18.0/{phone_number_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"}
-        data = {
-            "messaging_product": "whatsapp",
-            "to": to_phone,
-            "type": "text",
-            "text": {
-                "body": message}}
-        async with httpx.AsyncClient() as client:
-            await client.post(url, headers=headers, json=data)
+        access_token, phone_number_id = credentials
+        await whatsapp_client.send_text(access_token, phone_number_id, to_phone, message)
     except Exception as e:
         print(f"Error sending WhatsApp: {e}")
 
@@ -0,0 +1,117 @@
+import sys
+import os
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+
+# Agregar backend al PYTHONPATH
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+from database import db
+from services.indexes import apply_indexes
+
+
+NOW = datetime.utcnow()
+SAMPLE = "audit"
+
+# (origen, colección, filtro, sort) de cada consulta de rutas y servicios
+QUERY_SHAPES = [
+    ("POST /api/auth/login", "users", {"email": SAMPLE}, None),
+    ("GET /api/auth/me", "users", {"id": SAMPLE}, None),
+    ("GET /api/agencies/{id}", "agencies", {"id": SAMPLE}, None),
+    ("agency_routing fallback", "agencies", {"is_active": True}, None),
+    ("GET /api/cars", "cars", {"agency_id": SAMPLE, "is_available": True}, None),
+    ("GET /api/cars?brand", "cars", {"agency_id": SAMPLE, "brand": SAMPLE}, None),
+    ("GET /api/cars/{id}", "cars", {"id": SAMPLE}, None),
+    ("GET /api/promotions", "media_files", {"agency_id": SAMPLE, "category": "promotion"}, None),
+    ("GET /api/files?related_id", "media_files", {"related_id": SAMPLE}, None),
+    ("GET /api/files/{id}", "media_files", {"id": SAMPLE}, None),
+    ("agency_context promotions", "promotions", {"agency_id": SAMPLE, "is_active": True}, None),
+    ("get_or_create_customer", "customers", {"agency_id": SAMPLE, "phone": SAMPLE}, None),
+    ("GET /api/customers", "customers", {"agency_id": SAMPLE}, None),
+    ("GET /api/customers/{id}", "customers", {"id": SAMPLE}, None),
+    ("GET /api/dashboard meta_ads", "customers", {"agency_id": SAMPLE, "source": "meta_ads"}, None),
+    ("POST /api/appointments overlap", "appointments", {
+        "agency_id": SAMPLE,
+        "appointment_date": {"$gte": NOW - timedelta(minutes=30), "$lte": NOW + timedelta(minutes=30)},
+        "status": {"$in": ["pending", "confirmed"]}
+    }, None),
+    ("GET /api/appointments/today", "appointments", {
+        "agency_id": SAMPLE,
+        "appointment_date": {"$gte": NOW, "$lt": NOW + timedelta(days=1)}
+    }, None),
+    ("GET /api/appointments", "appointments", {
+        "deleted_at": {"$exists": False}, "agency_id": SAMPLE, "status": "pending"
+    }, None),
+    ("GET /api/appointments/{id}", "appointments", {"id": SAMPLE}, None),
+    ("cleanup_old_cancelled_appointments", "appointments", {
+        "status": "cancelled", "deleted_at": {"$lte": NOW}
+    }, None),
+    ("GET /api/conversations", "conversations", {"agency_id": SAMPLE}, [("last_message_at", -1)]),
+    ("GET /api/conversations/{id}", "conversations", {"id": SAMPLE}, None),
+    ("resolve_conversation", "conversations", {"agency_id": SAMPLE, "customer_id": SAMPLE}, None),
+    ("GET /api/messages", "messages", {"conversation_id": SAMPLE}, [("timestamp", 1)]),
+    ("get_recent_messages fallback", "messages", {"conversation_id": SAMPLE}, [("timestamp", -1)]),
+    ("agency_context config", "system_config", {"agency_id": SAMPLE}, None),
+    ("message_dedup claim", "processed_messages", {"message_id": SAMPLE}, None),
+    ("outbox claim", "outbox", {"status": "pending", "next_attempt_at": {"$lte": NOW}}, None),
+]
+
+
+def plan_stages(plan: dict) -> list[str]:
+    """
+    Etapas del plan ganador, de la raíz a las hojas.
+    """
+    stages = [plan.get("stage", "?")]
+    if "inputStage" in plan:
+        stages += plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+
+def winning_plan(explain: dict) -> dict:
+    planner = explain.get("queryPlanner", {})
+    plan = planner.get("winningPlan", {})
+    # Con el motor SBE el plan clásico viene dentro de `queryPlan`
+    return plan.get("queryPlan", plan)
+
+
+async def audit() -> int:
+    collscans = 0
+    for origin, collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = plan_stages(winning_plan(explain))
+
+        if "COLLSCAN" in stages:
+            status = "COLLSCAN"
+            collscans += 1
+        elif "SORT" in stages:
+            status = "SORT EN MEMORIA"
+        else:
+            status = "ok"
+        print(f"{status:<16} {collection:<20} {origin:<40} {' > '.join(stages)}")
+
+    print(f"\n{len(QUERY_SHAPES)} consultas, {collscans} con COLLSCAN")
+    return 1 if collscans else 0
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Corre explain() sobre cada consulta conocida y marca COLLSCAN"
+    )
+    parser.add_argument("--apply", action="store_true", help="crear los índices antes de auditar")
+    args = parser.parse_args()
+
+    if args.apply:
+        result = await apply_indexes()
+        print(f"[INDEXES] {result}\n")
+    sys.exit(await audit())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
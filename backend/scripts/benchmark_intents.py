@@ -0,0 +1,78 @@
+import sys
+import os
+import re
+import time
+
+# Agregar backend al PYTHONPATH
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+from services.intent_matcher import INTENT_KEYWORDS, intent_matcher
+from routes.whatsapp import TIME_NUMBER_RE
+
+
+SAMPLE_MESSAGES = [
+    "hola",
+    "Hola buenas tardes, busco un auto seminuevo",
+    "qué autos tienen disponibles?",
+    "¿tienen alguna promoción este mes?",
+    "quiero agendar una cita para el viernes a las 4 pm",
+    "cuanto cuesta el jetta 2022 y qué opciones de financiamiento hay",
+    "dónde están ubicados? cuál es su horario",
+    "ok gracias",
+    "paso mañana como a las 11",
+    "me interesa la camioneta roja que publicaron en facebook, sigue disponible?",
+    "perfecto nos vemos",
+    "buen día, mi esposo y yo queremos ir a ver un sedán familiar el sábado",
+]
+
+
+def legacy_classify(message: str) -> set[str]:
+    """
+    Réplica de los escaneos `any(kw in message_lower ...)` anteriores.
+    """
+    message_lower = message.lower()
+    found = set()
+    for intent, keywords in INTENT_KEYWORDS.items():
+        if any(kw.rstrip("*") in message_lower for kw in list(keywords)):
+            found.add(intent)
+    if re.search(r'\d{1,2}(?::\d{2})?\s*(?:am|pm|hrs?)?', message_lower):
+        found.add("time_number")
+    return found
+
+
+def compiled_classify(message: str) -> set[str]:
+    message_lower = message.lower()
+    found = intent_matcher.classify(message_lower)
+    if TIME_NUMBER_RE.search(message_lower):
+        found.add("time_number")
+    return found
+
+
+def bench(fn, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in SAMPLE_MESSAGES:
+            fn(message)
+    elapsed = time.perf_counter() - started
+    return rounds * len(SAMPLE_MESSAGES) / elapsed
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    legacy = bench(legacy_classify, rounds)
+    compiled = bench(compiled_classify, rounds)
+    print(f"Mensajes por ronda: {len(SAMPLE_MESSAGES)}, rondas: {rounds}")
+    print(f"Escaneo any() por intención: {legacy:,.0f} msg/s")
+    print(f"Matcher compilado, una pasada: {compiled:,.0f} msg/s")
+    print(f"Mejora: {compiled / legacy:.2f}x")
+
+    # Falsos positivos de la búsqueda por subcadena ("ir" dentro de "mañana"...)
+    for message in SAMPLE_MESSAGES:
+        extra = legacy_classify(message) - compiled_classify(message)
+        if extra:
+            print(f"  subcadena: {message!r} -> {sorted(extra)}")
+
+
+if __name__ == "__main__":
+    main()
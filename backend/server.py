@@ -3,10 +3,10 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
+from contextlib import asynccontextmanager
 
 #rutas test-chat
 #from routes import test_chat#
@@ -18,13 +18,41 @@ from routes import auth, agencies, cars, files, promotions, customers, appointme
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'automotive_agency')]
+import database
+from services.webhook_queue import webhook_pool
+from services.whatsapp_client import whatsapp_client
+from services.outbox import outbox_dispatcher
+from services.message_coalescer import message_coalescer
+from services.gemini_clients import gemini_clients
+from services.indexes import apply_indexes
+from services.message_writer import message_writer
+from services.request_db_metrics import MongoTimingMiddleware
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sin Mongo no hay nada que servir: si el ping falla, falla el arranque
+    await database.connect()
+    try:
+        await apply_indexes()
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+    await message_writer.start()
+    await whatsapp_client.start()
+    await outbox_dispatcher.start()
+    await webhook_pool.start()
+    yield
+    await message_coalescer.flush_all()
+    await webhook_pool.stop()
+    await message_writer.stop()
+    await outbox_dispatcher.stop()
+    await whatsapp_client.close()
+    await gemini_clients.close_all()
+    database.close()
+
 
 # Create the main app
-app = FastAPI(title="Automotive Agency API")
+app = FastAPI(title="Automotive Agency API", lifespan=lifespan)
 
 # Mount uploads directory for serving files - USE RELATIVE PATH
 uploads_dir = ROOT_DIR / "uploads"
@@ -54,6 +82,9 @@ app.include_router(whatsapp.router)
 app.include_router(dashboard.router)
 app.include_router(test_chat.router)
 
+# Conteo de comandos Mongo por request (Server-Timing + log de lentos)
+app.add_middleware(MongoTimingMiddleware)
+
 # CORS configuration
 app.add_middleware(
     CORSMiddleware,
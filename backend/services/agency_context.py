@@ -0,0 +1,128 @@
+# services/agency_context.py
+
+import asyncio
+import itertools
+import os
+import time
+from datetime import datetime
+
+from database import (
+    system_config_collection,
+    cars_collection,
+    promotions_collection,
+    agencies_collection,
+)
+from services.response_cache import response_cache
+from services.inventory_search import InventoryIndex
+
+
+AGENCY_CONTEXT_TTL = float(os.environ.get("AGENCY_CONTEXT_TTL", "300"))
+
+# Versión global y creciente: nunca se repite aunque se borre el snapshot
+_versions = itertools.count(1)
+
+
+class AgencySnapshot:
+    """
+    Foto en memoria de lo que la IA necesita de una agencia: config,
+    autos disponibles, promociones activas y datos de la agencia.
+    """
+
+    def __init__(self, agency_id: str, config: dict | None, cars: list,
+                 promotions: list, agency: dict | None):
+        self.agency_id = agency_id
+        self.config = config
+        self.cars = cars
+        self.promotions = promotions
+        self.agency = agency
+        self.version = next(_versions)
+        self.loaded_at = time.monotonic()
+        self._inventory: InventoryIndex | None = None
+
+    @property
+    def inventory(self) -> InventoryIndex:
+        if self._inventory is None:
+            self._inventory = InventoryIndex(self.cars)
+        return self._inventory
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.loaded_at < AGENCY_CONTEXT_TTL
+
+    def current_promotions(self, now: datetime | None = None) -> list:
+        """
+        Promociones activas cuya vigencia incluye `now`.
+        """
+        now = now or datetime.utcnow()
+        return [
+            promo for promo in self.promotions
+            if promo.get("start_date") and promo.get("end_date")
+            and promo["start_date"] <= now <= promo["end_date"]
+        ]
+
+
+class AgencyContextCache:
+    """
+    Snapshots por agencia con TTL e invalidación explícita desde las rutas
+    de escritura (autos, promociones, config y agencias).
+    """
+
+    def __init__(self):
+        self._snapshots: dict[str, AgencySnapshot] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _load(self, agency_id: str) -> AgencySnapshot:
+        config, cars, promotions, agency = await asyncio.gather(
+            system_config_collection.find_one({"agency_id": agency_id}, {"_id": 0}),
+            cars_collection.find(
+                {"agency_id": agency_id, "is_available": True},
+                {"_id": 0}
+            ).to_list(100),
+            promotions_collection.find(
+                {"agency_id": agency_id, "is_active": True},
+                {"_id": 0}
+            ).to_list(100),
+            agencies_collection.find_one({"id": agency_id}, {"_id": 0}),
+        )
+        return AgencySnapshot(agency_id, config, cars, promotions, agency)
+
+    async def get(self, agency_id: str) -> AgencySnapshot:
+        snapshot = self._snapshots.get(agency_id)
+        if snapshot and snapshot.is_fresh():
+            self.hits += 1
+            return snapshot
+
+        lock = self._locks.setdefault(agency_id, asyncio.Lock())
+        async with lock:
+            snapshot = self._snapshots.get(agency_id)
+            if snapshot and snapshot.is_fresh():
+                self.hits += 1
+                return snapshot
+            self.misses += 1
+            snapshot = await self._load(agency_id)
+            self._snapshots[agency_id] = snapshot
+            return snapshot
+
+    def peek(self, agency_id: str) -> AgencySnapshot | None:
+        """
+        Snapshot ya cargado (aunque esté vencido), sin tocar la DB.
+        """
+        return self._snapshots.get(agency_id)
+
+    def invalidate(self, agency_id: str | None = None) -> None:
+        if agency_id is None:
+            self._snapshots.clear()
+        else:
+            self._snapshots.pop(agency_id, None)
+        response_cache.flush(agency_id)
+
+    def stats(self) -> dict:
+        return {
+            "agencies": len(self._snapshots),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+agency_context = AgencyContextCache()
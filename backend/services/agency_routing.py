@@ -0,0 +1,74 @@
+# services/agency_routing.py
+
+import asyncio
+
+from database import agencies_collection, system_config_collection
+from services.message_coalescer import DEFAULT_DEBOUNCE_MS
+
+
+class AgencyRoutingTable:
+    """
+    Mapa en memoria `phone_number_id` -> `agency_id` para enrutar webhooks.
+
+    Se construye una sola vez desde `system_config.whatsapp_phone_number_id`
+    y se invalida cuando cambia la configuración o las agencias. Los
+    números sin configuración caen en la agencia por defecto (la primera
+    activa), igual que antes. También guarda la ventana de agrupación de
+    mensajes (`message_debounce_ms`) de cada agencia.
+    """
+
+    def __init__(self):
+        self._routes: dict[str, str] | None = None
+        self._default_agency_id: str | None = None
+        self._debounce_ms: dict[str, int] = {}
+        self._lock = asyncio.Lock()
+
+    async def _build(self) -> None:
+        routes = {}
+        debounce_ms = {}
+        configs = system_config_collection.find(
+            {},
+            {"_id": 0, "agency_id": 1, "whatsapp_phone_number_id": 1, "message_debounce_ms": 1}
+        )
+        async for config in configs:
+            if config.get("whatsapp_phone_number_id"):
+                routes[config["whatsapp_phone_number_id"]] = config["agency_id"]
+            if config.get("message_debounce_ms") is not None:
+                debounce_ms[config["agency_id"]] = config["message_debounce_ms"]
+
+        agency = await agencies_collection.find_one({"is_active": True}, {"_id": 0, "id": 1})
+        if not agency:
+            agency = await agencies_collection.find_one({}, {"_id": 0, "id": 1})
+
+        self._default_agency_id = agency["id"] if agency else None
+        self._debounce_ms = debounce_ms
+        self._routes = routes
+
+    async def _ensure_loaded(self) -> None:
+        if self._routes is None:
+            async with self._lock:
+                if self._routes is None:
+                    await self._build()
+
+    async def resolve(self, phone_number_id: str | None) -> str | None:
+        await self._ensure_loaded()
+        if phone_number_id and phone_number_id in self._routes:
+            return self._routes[phone_number_id]
+        return self._default_agency_id
+
+    async def debounce_ms(self, agency_id: str) -> int:
+        await self._ensure_loaded()
+        return self._debounce_ms.get(agency_id, DEFAULT_DEBOUNCE_MS)
+
+    def invalidate(self) -> None:
+        self._routes = None
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self._routes is not None,
+            "routes": len(self._routes or {}),
+            "default_agency_id": self._default_agency_id,
+        }
+
+
+agency_routing = AgencyRoutingTable()
@@ -1,14 +1,14 @@
 # services/chat_engine.py
 
-import uuid
+import asyncio
 import json
 import re
-from datetime import datetime
+from typing import AsyncIterator
 
-from database import conversations_collection, messages_collection
 from services.ai_service import handle_ai_action
-from routes.whatsapp import detect_and_create_appointment, generate_ai_response
-from services.customer_service import get_or_create_customer
+from routes.whatsapp import detect_and_create_appointment, generate_ai_response, stream_ai_response
+from services.message_pipeline import MessagePipeline, MessageTurn, load_agency_context, pipeline_metrics
+from services.conversation_locks import conversation_locks, conversation_key
 from models import LeadSource
 
 
@@ -32,117 +32,183 @@ def extract_json_from_ai(text: str) -> dict | None:
         return None
 
 
+def _chat_turn(agency_id: str, customer_identifier: str, message_text: str, is_test: bool) -> MessageTurn:
+    return MessageTurn(
+        agency_id=agency_id,
+        channel="test_chat" if is_test else "whatsapp",
+        message_text=message_text,
+        phone=customer_identifier,
+        source=LeadSource.WHATSAPP,
+        whatsapp_phone=customer_identifier if not is_test else "test-chat"
+    )
+
+
+def _appointment_reply(appointment: dict) -> str:
+    return f"✅ Cita creada\n📅 {appointment['date']} 🕐 {appointment['time']}"
+
+
+async def _resolve_ai_reply(customer_id: str, ai_response: str) -> str:
+    """
+    Si la IA regresó una acción (JSON) la ejecuta; si no, regresa el texto.
+    """
+    action_payload = extract_json_from_ai(ai_response)
+
+    if action_payload and action_payload.get("action") == "create_appointment":
+        appointment_date = action_payload.get("appointment_date")
+
+        if not appointment_date or len(appointment_date) < 16:
+            return (
+                "❌ No pude confirmar correctamente la fecha de la cita.\n"
+                "¿Puedes repetirla con día y hora?"
+            )
+
+        normalized_action = {
+            "action": "create_appointment",
+            "data": {
+                "customer_id": customer_id,
+                "appointment_date": appointment_date,
+                "notes": action_payload.get("notes")
+            }
+        }
+
+        result = await handle_ai_action(normalized_action)
+        return result["message"]
+
+    return ai_response
+
+
+async def _chat_reply(turn: MessageTurn) -> str:
+    if turn.intent:
+        return _appointment_reply(turn.intent)
+    ai_response = await generate_ai_response(
+        turn.agency_id,
+        turn.conversation_id,
+        turn.message_text,
+        turn.history
+    )
+    return await _resolve_ai_reply(turn.customer_id, ai_response)
+
+
+chat_pipeline = MessagePipeline(
+    detect_intent=detect_and_create_appointment,
+    generate_reply=_chat_reply,
+    prefetch=load_agency_context
+)
+
+
 async def handle_chat_message(
     agency_id: str,
     customer_identifier: str,
     message_text: str,
     is_test: bool = False
 ):
-    # 1. Cliente
-    customer = await get_or_create_customer(
-        agency_id=agency_id,
-        phone=customer_identifier,
-        source=LeadSource.WHATSAPP
-    )
-    customer_id = customer["id"]
-
-    # 2. Buscar conversación
-    conversation = await conversations_collection.find_one({
-        "agency_id": agency_id,
-        "customer_id": customer_id
-    })
-
-    if not conversation:
-        conversation_id = str(uuid.uuid4())
-        await conversations_collection.insert_one({
-            "id": conversation_id,
-            "agency_id": agency_id,
-            "customer_id": customer_id,
-            "whatsapp_phone": customer_identifier if not is_test else "test-chat",
-            "last_message": message_text,
-            "last_message_at": datetime.utcnow(),
-            "created_at": datetime.utcnow(),
-            "conversation_state": {}
-        })
-    else:
-        conversation_id = conversation["id"]
-        await conversations_collection.update_one(
-            {"id": conversation_id},
-            {"$set": {
-                "last_message": message_text,
-                "last_message_at": datetime.utcnow()
-            }}
-        )
-
-    # 3. Guardar mensaje entrante
-    await messages_collection.insert_one({
-        "id": str(uuid.uuid4()),
-        "conversation_id": conversation_id,
-        "from_customer": True,
-        "message_text": message_text,
-        "timestamp": datetime.utcnow()
-    })
-
-    # 4. Detectar cita
-    appointment = await detect_and_create_appointment(
-        agency_id,
-        customer_id,
-        message_text,
-        conversation_id
-    )
+    turn = _chat_turn(agency_id, customer_identifier, message_text, is_test)
+    async with conversation_locks.hold(conversation_key(agency_id, customer_identifier)):
+        await chat_pipeline.run(turn)
+
+    return turn.response_text, turn.conversation_id
+
+
+# Prefijo mínimo antes de decidir si la respuesta es texto o una acción
+_ACTION_SNIFF_CHARS = 8
+
+_STREAM_DONE = object()
+
+# Turnos en streaming que siguen corriendo aunque el cliente se desconecte
+_background_turns: set[asyncio.Task] = set()
 
-    if appointment:
-        response_text = (
-            f"✅ Cita creada\n📅 {appointment['date']} 🕐 {appointment['time']}"
-        )
-    else:
-        ai_response = await generate_ai_response(
-            agency_id,
-            conversation_id,
-            message_text
-        )
-
-        action_payload = extract_json_from_ai(ai_response)
-
-        if action_payload and action_payload.get("action") == "create_appointment":
-            appointment_date = action_payload.get("appointment_date")
-
-            if not appointment_date or len(appointment_date) < 16:
-                response_text = (
-                    "❌ No pude confirmar correctamente la fecha de la cita.\n"
-                    "¿Puedes repetirla con día y hora?"
-                )
-            else:
-                normalized_action = {
-                    "action": "create_appointment",
-                    "data": {
-                        "customer_id": customer_id,
-                        "appointment_date": appointment_date,
-                        "notes": action_payload.get("notes")
-                    }
-                }
-
-                result = await handle_ai_action(normalized_action)
-                response_text = result["message"]
-        else:
-            response_text = ai_response
-
-    # 5. Guardar respuesta
-    await messages_collection.insert_one({
-        "id": str(uuid.uuid4()),
-        "conversation_id": conversation_id,
-        "from_customer": False,
-        "message_text": response_text,
-        "timestamp": datetime.utcnow()
-    })
-
-    # 6. Actualizar conversación con respuesta
-    await conversations_collection.update_one(
-        {"id": conversation_id},
-        {"$set": {
-            "last_message": response_text,
-            "last_message_at": datetime.utcnow()
-        }}
-    )
 
-    return response_text, conversation_id
+def _forget_background_turn(task: asyncio.Task) -> None:
+    _background_turns.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"Error streaming chat turn: {task.exception()}")
+
+
+def _looks_like_action(text: str) -> bool:
+    """
+    Si el modelo está escribiendo un JSON de acción no se reenvía al cliente:
+    el resultado de la acción llega en el evento final.
+    """
+    stripped = text.lstrip()
+    return stripped.startswith(("{", "```")) or '"action"' in text
+
+
+async def _stream_turn(turn: MessageTurn, lock_key: str, tokens: asyncio.Queue) -> None:
+    """
+    Genera la respuesta, manda los tokens a `tokens` y guarda el turno. Corre
+    como tarea propia para terminar de guardar aunque el cliente se vaya.
+    """
+    try:
+        if turn.intent:
+            turn.response_text = _appointment_reply(turn.intent)
+            tokens.put_nowait(turn.response_text)
+        else:
+            chunks = []
+            held = 0
+            forwarding = True
+            async with pipeline_metrics.stage("generate_reply"):
+                async for token in stream_ai_response(
+                    turn.agency_id,
+                    turn.conversation_id,
+                    turn.message_text,
+                    turn.history
+                ):
+                    chunks.append(token)
+                    text = "".join(chunks)
+                    if not forwarding or len(text.strip()) < _ACTION_SNIFF_CHARS:
+                        continue
+                    if _looks_like_action(text):
+                        forwarding = False
+                        continue
+                    for pending in chunks[held:]:
+                        tokens.put_nowait(pending)
+                    held = len(chunks)
+
+            ai_response = "".join(chunks)
+            if forwarding and not _looks_like_action(ai_response):
+                for pending in chunks[held:]:
+                    tokens.put_nowait(pending)
+            turn.response_text = await _resolve_ai_reply(turn.customer_id, ai_response)
+
+        async with conversation_locks.hold(lock_key):
+            await chat_pipeline.finish(turn)
+    finally:
+        tokens.put_nowait(_STREAM_DONE)
+
+
+async def stream_chat_message(
+    agency_id: str,
+    customer_identifier: str,
+    message_text: str,
+    is_test: bool = False
+) -> AsyncIterator[dict]:
+    """
+    Versión streaming de `handle_chat_message`.
+
+    Emite `{"token": ...}` conforme llega el texto del modelo y al final
+    `{"done": True, "response": ..., "conversation_id": ...}` con la
+    respuesta ya procesada (acciones ejecutadas) y guardada.
+
+    El lock de la conversación solo cubre las escrituras de inicio y fin:
+    no se mantiene mientras el cliente consume el stream. Si el cliente se
+    desconecta la respuesta se termina de generar y se guarda igual.
+    """
+    turn = _chat_turn(agency_id, customer_identifier, message_text, is_test)
+    lock_key = conversation_key(agency_id, customer_identifier)
+    async with conversation_locks.hold(lock_key):
+        await chat_pipeline.prepare(turn)
+
+    tokens: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(_stream_turn(turn, lock_key, tokens))
+    _background_turns.add(task)
+    task.add_done_callback(_forget_background_turn)
+
+    while (token := await tokens.get()) is not _STREAM_DONE:
+        yield {"token": token}
+    await task
+
+    yield {
+        "done": True,
+        "response": turn.response_text,
+        "conversation_id": turn.conversation_id
+    }
@@ -0,0 +1,154 @@
+# services/circuit_breaker.py
+
+import os
+import time
+from collections import deque
+
+
+BREAKER_WINDOW = int(os.environ.get("GEMINI_BREAKER_WINDOW", "50"))
+BREAKER_MIN_CALLS = int(os.environ.get("GEMINI_BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.environ.get("GEMINI_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_MS = float(os.environ.get("GEMINI_BREAKER_SLOW_MS", "15000"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("GEMINI_BREAKER_OPEN_SECONDS", "30"))
+# Percentil de latencia a partir del cual se responde con el fallback (0 = sin hedging)
+HEDGE_PERCENTILE = float(os.environ.get("GEMINI_HEDGE_PERCENTILE", "95"))
+# "fallback": responde con el fallback y la respuesta tardía solo se cachea.
+# "duplicate": lanza una segunda llamada al modelo y usa la primera que
+# termine (duplica la carga sobre la API key).
+HEDGE_MODE = os.environ.get("GEMINI_HEDGE_MODE", "fallback")
+HEDGE_MIN_SECONDS = float(os.environ.get("GEMINI_HEDGE_MIN_SECONDS", "3"))
+HEDGE_MAX_SECONDS = float(os.environ.get("GEMINI_HEDGE_MAX_SECONDS", "20"))
+
+
+class BreakerState:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class _KeyBreaker:
+    def __init__(self):
+        self.calls: deque[tuple[float, bool]] = deque(maxlen=BREAKER_WINDOW)
+        self.state = BreakerState.CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.short_circuited = 0
+        self.hedged = 0
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class LatencyCircuitBreaker:
+    """
+    Circuit breaker por API key basado en una ventana móvil de latencias y
+    errores de Gemini.
+
+    - Se abre si la tasa de error o la latencia p95 de la ventana superan
+      el umbral; mientras está abierto no se llama al modelo.
+    - Tras `BREAKER_OPEN_SECONDS` pasa a half-open y deja pasar una sola
+      llamada de prueba que decide si vuelve a cerrarse.
+    - `hedge_timeout` da el percentil de latencia observado, para responder
+      con el fallback (o, con `HEDGE_MODE="duplicate"`, lanzar una segunda
+      llamada) si el modelo tarda más que eso.
+    """
+
+    def __init__(self):
+        self._keys: dict[str, _KeyBreaker] = {}
+
+    def _breaker(self, key: str) -> _KeyBreaker:
+        breaker = self._keys.get(key)
+        if breaker is None:
+            breaker = _KeyBreaker()
+            self._keys[key] = breaker
+        return breaker
+
+    def allow(self, key: str) -> bool:
+        breaker = self._breaker(key)
+        if breaker.state == BreakerState.CLOSED:
+            return True
+        if breaker.state == BreakerState.OPEN:
+            if time.monotonic() - breaker.opened_at < BREAKER_OPEN_SECONDS:
+                breaker.short_circuited += 1
+                return False
+            breaker.state = BreakerState.HALF_OPEN
+            breaker.probe_in_flight = False
+        if breaker.probe_in_flight:
+            breaker.short_circuited += 1
+            return False
+        breaker.probe_in_flight = True
+        return True
+
+    def release(self, key: str) -> None:
+        """
+        Libera la llamada de prueba sin registrar resultado (la llamada no
+        llegó al modelo).
+        """
+        self._breaker(key).probe_in_flight = False
+
+    def record(self, key: str, latency: float, ok: bool) -> None:
+        breaker = self._breaker(key)
+        breaker.calls.append((latency, ok))
+
+        if breaker.state == BreakerState.HALF_OPEN:
+            breaker.probe_in_flight = False
+            if ok and latency * 1000 < BREAKER_SLOW_MS:
+                breaker.state = BreakerState.CLOSED
+                breaker.calls.clear()
+            else:
+                self._open(breaker)
+            return
+
+        if breaker.state == BreakerState.CLOSED and self._should_open(breaker):
+            self._open(breaker)
+
+    def _should_open(self, breaker: _KeyBreaker) -> bool:
+        if len(breaker.calls) < BREAKER_MIN_CALLS:
+            return False
+        errors = sum(1 for _, ok in breaker.calls if not ok)
+        if errors / len(breaker.calls) >= BREAKER_ERROR_RATE:
+            return True
+        latencies = [latency for latency, _ in breaker.calls]
+        return _percentile(latencies, 95) * 1000 >= BREAKER_SLOW_MS
+
+    def _open(self, breaker: _KeyBreaker) -> None:
+        breaker.state = BreakerState.OPEN
+        breaker.opened_at = time.monotonic()
+
+    def hedge_timeout(self, key: str) -> float | None:
+        if HEDGE_PERCENTILE <= 0:
+            return None
+        breaker = self._breaker(key)
+        latencies = [latency for latency, ok in breaker.calls if ok]
+        if len(latencies) < BREAKER_MIN_CALLS:
+            return None
+        return min(
+            HEDGE_MAX_SECONDS,
+            max(HEDGE_MIN_SECONDS, _percentile(latencies, HEDGE_PERCENTILE))
+        )
+
+    def mark_hedged(self, key: str) -> None:
+        self._breaker(key).hedged += 1
+
+    def stats(self) -> dict:
+        result = {}
+        for index, breaker in enumerate(self._keys.values()):
+            latencies = [latency for latency, _ in breaker.calls]
+            errors = sum(1 for _, ok in breaker.calls if not ok)
+            # No se exponen las API keys, solo un índice
+            result[f"key_{index}"] = {
+                "state": breaker.state,
+                "calls": len(breaker.calls),
+                "error_rate": round(errors / len(latencies), 3) if latencies else 0.0,
+                "p50_ms": round(_percentile(latencies, 50) * 1000, 1) if latencies else None,
+                "p95_ms": round(_percentile(latencies, 95) * 1000, 1) if latencies else None,
+                "short_circuited": breaker.short_circuited,
+                "hedged": breaker.hedged
+            }
+        return result
+
+
+gemini_breaker = LatencyCircuitBreaker()
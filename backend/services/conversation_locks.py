@@ -0,0 +1,81 @@
+# services/conversation_locks.py
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class _KeyLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class KeyedLocks:
+    """
+    Un lock asyncio por llave (agencia + teléfono): el trabajo de una misma
+    conversación se ejecuta en serie y conversaciones distintas en paralelo.
+
+    El lock de una llave existe solo mientras alguien lo tiene o lo espera;
+    al soltarlo el último se elimina, así no se acumulan llaves inactivas.
+    """
+
+    def __init__(self):
+        self._locks: dict[str, _KeyLock] = {}
+        self._acquired = 0
+        self._contended = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = _KeyLock()
+        entry.users += 1
+
+        contended = entry.lock.locked()
+        started = time.monotonic()
+        try:
+            await entry.lock.acquire()
+        except BaseException:
+            self._release_entry(key, entry)
+            raise
+
+        waited = time.monotonic() - started
+        self._acquired += 1
+        if contended:
+            self._contended += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+        try:
+            yield
+        finally:
+            entry.lock.release()
+            self._release_entry(key, entry)
+
+    def _release_entry(self, key: str, entry: _KeyLock) -> None:
+        entry.users -= 1
+        if entry.users == 0 and self._locks.get(key) is entry:
+            del self._locks[key]
+
+    def stats(self) -> dict:
+        return {
+            "active_keys": len(self._locks),
+            "waiting": sum(e.users - 1 for e in self._locks.values() if e.lock.locked()),
+            "acquired": self._acquired,
+            "contended": self._contended,
+            "avg_wait_ms": round(self._total_wait / self._contended * 1000, 2) if self._contended else 0.0,
+            "max_wait_ms": round(self._max_wait * 1000, 2),
+        }
+
+
+def conversation_key(agency_id: str, phone: str) -> str:
+    return f"{agency_id}:{phone}"
+
+
+conversation_locks = KeyedLocks()
@@ -1,17 +1,15 @@
+import copy
 from datetime import datetime, timedelta
-import uuid
-import re
 from typing import Literal
 
-from database import (
-    conversations_collection,
-    messages_collection,
-    customers_collection,
-    agencies_collection,
-)
+from database import agencies_collection
 from models import AppointmentCreate
 from services.appointment_service import create_appointment
+from services.intent_matcher import intent_matcher
+from services.datetime_extraction import extract_date, extract_time, extract_datetime
+from services.message_pipeline import MessagePipeline, MessageTurn
 from services.conversation_state_service import (
+    ConversationStateConflict,
     get_conversation_state,
     update_conversation_state
 )
@@ -33,6 +31,10 @@ DEFAULT_STATE = {
 }
 
 
+# Intentos de aplicar una transición cuando otro worker cambió el estado
+STATE_CONFLICT_RETRIES = 3
+
+
 def _merge_state(old: dict | None, new: dict) -> dict:
     if not old:
         return new
@@ -61,82 +63,71 @@ async def handle_conversation_message(
         "response": str
     }
     """
+    turn = MessageTurn(
+        agency_id=agency_id,
+        channel=channel,
+        message_text=message,
+        phone=from_phone,
+        conversation_id=conversation_id,
+        source=channel,
+        customer_name=from_phone,
+        whatsapp_phone=from_phone
+    )
+    await conversation_pipeline.run(turn)
 
-    # ----------------------------------------------
-    # 1. Cliente
-    # ----------------------------------------------
-    customer_id = None
-    if from_phone:
-        customer = await customers_collection.find_one(
-            {"phone": from_phone, "agency_id": agency_id}
-        )
-        if not customer:
-            customer_id = str(uuid.uuid4())
-            await customers_collection.insert_one({
-                "id": customer_id,
-                "agency_id": agency_id,
-                "name": from_phone,
-                "phone": from_phone,
-                "source": channel,
-                "created_at": datetime.utcnow()
-            })
-        else:
-            customer_id = customer["id"]
+    return {
+        "conversation_id": turn.conversation_id,
+        "response": turn.response_text
+    }
 
-    # ----------------------------------------------
-    # 2. Conversación
-    # ----------------------------------------------
-    if not conversation_id:
-        conversation_id = str(uuid.uuid4())
-        await conversations_collection.insert_one({
-            "id": conversation_id,
-            "agency_id": agency_id,
-            "customer_id": customer_id,
-            "whatsapp_phone": from_phone,
-            "created_at": datetime.utcnow(),
-            "last_message": message,
-            "last_message_at": datetime.utcnow()
-        })
-    else:
-        await conversations_collection.update_one(
-            {"id": conversation_id},
-            {"$set": {
-                "last_message": message,
-                "last_message_at": datetime.utcnow()
-            }}
-        )
 
-    # ----------------------------------------------
-    # 3. Guardar mensaje
-    # ----------------------------------------------
-    await messages_collection.insert_one({
-        "id": str(uuid.uuid4()),
-        "conversation_id": conversation_id,
-        "from_customer": True,
-        "message_text": message,
-        "timestamp": datetime.utcnow()
-    })
+async def _classify(turn: MessageTurn) -> set[str]:
+    return intent_matcher.classify(turn.message_text)
+
+
+async def _reply_from_state(turn: MessageTurn) -> str:
+    # Si otro worker avanzó el estado primero, el cache local ya se
+    # descartó: se relee de Mongo y se vuelve a aplicar la transición
+    for _ in range(STATE_CONFLICT_RETRIES):
+        try:
+            return await _advance_state(turn)
+        except ConversationStateConflict:
+            continue
+    raise ConversationStateConflict(turn.conversation_id)
+
+
+async def _advance_state(turn: MessageTurn) -> str:
+    agency_id = turn.agency_id
+    conversation_id = turn.conversation_id
+    message = turn.message_text
 
     # ----------------------------------------------
     # 4. Estado
     # ----------------------------------------------
     state = await get_conversation_state(conversation_id)
     if not state:
-        state = DEFAULT_STATE.copy()
+        state = copy.deepcopy(DEFAULT_STATE)
         state["data"]["agency_id"] = agency_id
 
     # ----------------------------------------------
     # 5. Intento simple (cita)
     # ----------------------------------------------
     if state["intent"] is None:
-        if any(w in message.lower() for w in ["cita", "agendar", "visitar"]):
+        if "appointment" in turn.intent:
             state["intent"] = "appointment"
             state["step"] = "date"
+
+            # Si ya trae fecha y hora se pasa directo a confirmar
+            parsed_date, parsed_time = extract_datetime(message)
+            if parsed_date and parsed_time:
+                state["data"]["date"] = parsed_date.isoformat()
+                state["data"]["time"] = parsed_time.strftime("%H:%M")
+                state["step"] = "confirm"
+                await update_conversation_state(conversation_id, state)
+                return _confirmation_prompt(state)
+
             await update_conversation_state(conversation_id, state)
-            return {
-                "conversation_id": conversation_id,
-                "response": "¡Perfecto! ¿Qué día te gustaría venir?"
-            }
+            return "¡Perfecto! ¿Qué día te gustaría venir?"
 
     # ----------------------------------------------
     # 6. Flujo de cita
@@ -145,53 +136,45 @@ async def handle_conversation_message(
 
         # Fecha
         if state["step"] == "date":
-            parsed_date = _extract_date(message)
+            parsed_date = extract_date(message)
             if not parsed_date:
-                return {
-                    "conversation_id": conversation_id,
-                    "response": "¿Me indicas el día de tu visita? (ej. mañana, viernes, 12 de mayo)"
-                }
-            state["data"]["date"] = parsed_date
+                return "¿Me indicas el día de tu visita? (ej. mañana, viernes, 12 de mayo)"
+            state["data"]["date"] = parsed_date.isoformat()
             state["step"] = "time"
             await update_conversation_state(conversation_id, state)
-            return {
-                "conversation_id": conversation_id,
-                "response": "Perfecto 👍 ¿A qué hora te gustaría?"
-            }
+            return "Perfecto 👍 ¿A qué hora te gustaría?"
 
         # Hora
         if state["step"] == "time":
-            parsed_time = _extract_time(message)
+            parsed_time = extract_time(message)
             if not parsed_time:
-                return {
-                    "conversation_id": conversation_id,
-                    "response": "¿Qué hora te funciona? (ej. 10:30, 4 pm)"
-                }
-            state["data"]["time"] = parsed_time
+                return "¿Qué hora te funciona? (ej. 10:30, 4 pm)"
+            state["data"]["time"] = parsed_time.strftime("%H:%M")
             state["step"] = "confirm"
             await update_conversation_state(conversation_id, state)
-
-            return {
-                "conversation_id": conversation_id,
-                "response": (
-                    "Confírmame por favor:\n\n"
-                    f"📅 Fecha: {state['data']['date']}\n"
-                    f"🕐 Hora: {state['data']['time']}\n\n"
-                    "¿Confirmamos la cita? (sí / no)"
-                )
-            }
+            return _confirmation_prompt(state)
 
         # Confirmación
         if state["step"] == "confirm":
             if message.lower() not in ["sí", "si", "confirmar", "ok"]:
+                # Se vuelve a empezar: la cita anterior ya no cuenta
                 state["step"] = "date"
+                state["confirmed"] = False
+                state["data"]["date"] = None
+                state["data"]["time"] = None
                 await update_conversation_state(conversation_id, state)
-                return {
-                    "conversation_id": conversation_id,
-                    "response": "Sin problema 😊 ¿Qué día prefieres entonces?"
-                }
+                return "Sin problema 😊 ¿Qué día prefieres entonces?"
 
-            # Crear cita
+            if state["confirmed"]:
+                return "Tu cita ya está confirmada 😊 ¿En qué más puedo ayudarte?"
+
+            # Se marca confirmada antes de crear la cita: si otro worker ganó
+            # la transición, aquí falla la versión y no se duplica la cita
+            state["confirmed"] = True
+            await update_conversation_state(conversation_id, state)
+
+            # Crear cita (solo con el mensaje entrante ya guardado)
+            await turn.inbound_saved.wait()
             appointment_dt = datetime.fromisoformat(
                 f"{state['data']['date']}T{state['data']['time']}"
             )
@@ -199,18 +182,15 @@ async def handle_conversation_message(
             appointment = await create_appointment(
                 AppointmentCreate(
                     agency_id=agency_id,
-                    customer_id=customer_id,
+                    customer_id=turn.customer_id,
                     appointment_date=appointment_dt,
                     notes="Cita creada por IA",
                     created_by_ai=True,
                     ai_prompt=message,
-                    ai_extracted_data={"source": channel}
+                    ai_extracted_data={"source": turn.channel}
                 )
             )
 
-            state["confirmed"] = True
-            await update_conversation_state(conversation_id, state)
-
             agency = await agencies_collection.find_one({"id": agency_id})
 
             response = (
@@ -222,62 +202,28 @@ async def handle_conversation_message(
             if agency and agency.get("address"):
                 response += f"\n📍 {agency['address']}"
 
-            return {
-                "conversation_id": conversation_id,
-                "response": response
-            }
+            return response
 
     # ----------------------------------------------
-    # 7. Fallback IA general
+    # 7. Fallback controlado
     # ----------------------------------------------
-    #ai_text = await generate_ai_response(
-    #    agency_id=agency_id,
-     #   conversation_id=conversation_id,
-     #   user_message=message
-    #)
-
-    #return {
-     #   "conversation_id": conversation_id,
-      #  "response": ai_text
-    #}
-
-# ----------------------------------------------
-# 7. Fallback controlado
-# ----------------------------------------------
-    return {
-        "conversation_id": conversation_id,
-        "response": "Perfecto 😊 ¿En qué más puedo ayudarte?"
-    }
-
+    return "Perfecto 😊 ¿En qué más puedo ayudarte?"
 
-# ======================================================
-# Extractores simples
-# ======================================================
-
-def _extract_date(text: str) -> str | None:
-    text = text.lower()
-    today = datetime.utcnow().date()
-
-
-    match = re.search(r"(\d{1,2})[/-](\d{1,2})", text)
-    if match:
-        day, month = map(int, match.groups())
-        year = today.year
-        return datetime(year, month, day).date().isoformat()
 
-    return None
-
-
-def _extract_time(text: str) -> str | None:
-    match = re.search(r"(\d{1,2})(?::(\d{2}))?\s*(am|pm)?", text.lower())
-    if not match:
-        return None
+conversation_pipeline = MessagePipeline(
+    detect_intent=_classify,
+    generate_reply=_reply_from_state
+)
 
-    hour = int(match.group(1))
-    minute = int(match.group(2) or 0)
-    period = match.group(3)
 
-    if period == "pm" and hour < 12:
-        hour += 12
+# ======================================================
+# Respuestas
+# ======================================================
 
-    return f"{hour:02d}:{minute:02d}"
+def _confirmation_prompt(state: dict) -> str:
+    return (
+        "Confírmame por favor:\n\n"
+        f"📅 Fecha: {state['data']['date']}\n"
+        f"🕐 Hora: {state['data']['time']}\n\n"
+        "¿Confirmamos la cita? (sí / no)"
+    )
@@ -1,47 +1,113 @@
 # backend/services/conversation_state_service.py
 
-from datetime import datetime
-from typing import Dict
+import copy
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
+from database import conversations_collection
 
-# ⚠️ Estado en memoria (por ahora)
-# Luego lo pasamos a DB sin cambiar interfaces
-_CONVERSATION_STATES: Dict[str, dict] = {}
 
+# Estado persistido en `conversations.conversation_state`, con un cache LRU
+# write-through delante. Cada escritura sube `version`; si otro worker
+# escribió antes, la escritura falla en vez de pisar su estado y se saca
+# la copia del cache, así el reintento lee la versión de Mongo.
+STATE_CACHE_SIZE = int(os.environ.get("CONVERSATION_STATE_CACHE_SIZE", "5000"))
+STATE_IDLE_TTL = timedelta(
+    seconds=int(os.environ.get("CONVERSATION_STATE_IDLE_TTL", str(24 * 3600)))
+)
 
-async def get_or_create_conversation_state(conversation_id: str) -> dict:
+
+class ConversationStateConflict(Exception):
     """
-    Obtiene el estado actual de la conversación o lo crea si no existe.
+    Otro proceso actualizó el estado de la conversación primero.
     """
-    if conversation_id not in _CONVERSATION_STATES:
-        _CONVERSATION_STATES[conversation_id] = {
-            "conversation_id": conversation_id,
-            "step": "start",
-            "data": {},
-            "updated_at": datetime.utcnow()
-        }
 
-    return _CONVERSATION_STATES[conversation_id]
+
+_CACHE: OrderedDict[str, dict] = OrderedDict()
 
 
-async def update_conversation_state(
-    conversation_id: str,
-    step: str | None = None,
-    data: dict | None = None
-) -> dict:
+def _cache_put(conversation_id: str, state: dict) -> None:
+    _CACHE[conversation_id] = state
+    _CACHE.move_to_end(conversation_id)
+    while len(_CACHE) > STATE_CACHE_SIZE:
+        _CACHE.popitem(last=False)
+
+
+def _is_expired(state: dict) -> bool:
+    updated_at = state.get("updated_at")
+    return bool(updated_at) and datetime.utcnow() - updated_at > STATE_IDLE_TTL
+
+
+async def get_conversation_state(conversation_id: str) -> dict | None:
     """
-    Actualiza el estado de la conversación.
+    Estado actual de la conversación, o None si no tiene (o expiró por
+    inactividad). Regresa una copia: modificarla no afecta al cache.
     """
-    state = await get_or_create_conversation_state(conversation_id)
+    state = _CACHE.get(conversation_id)
+    if state is not None:
+        _CACHE.move_to_end(conversation_id)
+    else:
+        conversation = await conversations_collection.find_one(
+            {"id": conversation_id},
+            {"_id": 0, "conversation_state": 1}
+        )
+        state = (conversation or {}).get("conversation_state") or None
+        if state is None:
+            return None
+        _cache_put(conversation_id, state)
 
-    if step:
-        state["step"] = step
+    if _is_expired(state):
+        await reset_conversation_state(conversation_id)
+        return None
 
-    if data:
-        state["data"].update(data)
+    return copy.deepcopy(state)
 
-    state["updated_at"] = datetime.utcnow()
 
+async def update_conversation_state(conversation_id: str, state: dict) -> dict:
+    """
+    Guarda `state` si nadie lo cambió desde que se leyó (según `version`).
+    Lanza `ConversationStateConflict` si otro worker escribió primero.
+    """
+    current_version = state.get("version", 0)
+    new_state = copy.deepcopy(state)
+    new_state["version"] = current_version + 1
+    new_state["updated_at"] = datetime.utcnow()
+
+    if current_version:
+        version_filter = {"conversation_state.version": current_version}
+    else:
+        # Estado nuevo: solo si la conversación aún no tiene uno versionado
+        version_filter = {"$or": [
+            {"conversation_state.version": {"$exists": False}},
+            {"conversation_state.version": 0}
+        ]}
+
+    result = await conversations_collection.update_one(
+        {"id": conversation_id, **version_filter},
+        {"$set": {"conversation_state": new_state}}
+    )
+    if result.matched_count == 0:
+        _CACHE.pop(conversation_id, None)
+        raise ConversationStateConflict(conversation_id)
+
+    _cache_put(conversation_id, new_state)
+    return copy.deepcopy(new_state)
+
+
+async def get_or_create_conversation_state(conversation_id: str) -> dict:
+    """
+    Obtiene el estado actual de la conversación o uno inicial (sin guardar).
+    """
+    state = await get_conversation_state(conversation_id)
+    if state is None:
+        state = {
+            "conversation_id": conversation_id,
+            "step": "start",
+            "data": {},
+            "version": 0,
+            "updated_at": datetime.utcnow()
+        }
     return state
 
 
@@ -49,5 +115,12 @@ async def reset_conversation_state(conversation_id: str) -> None:
     """
     Reinicia el estado de la conversación.
     """
-    if conversation_id in _CONVERSATION_STATES:
-        del _CONVERSATION_STATES[conversation_id]
+    _CACHE.pop(conversation_id, None)
+    await conversations_collection.update_one(
+        {"id": conversation_id},
+        {"$unset": {"conversation_state": ""}}
+    )
+
+
+def state_cache_stats() -> dict:
+    return {"cached": len(_CACHE), "max": STATE_CACHE_SIZE}
@@ -0,0 +1,124 @@
+# services/conversation_store.py
+
+import asyncio
+import uuid
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import conversations_collection, messages_collection
+from services.message_writer import message_writer
+from services.recent_messages import RECENT_MESSAGES_LIMIT, recent_entry, push_recent
+
+
+def new_message(conversation_id: str | None, message_text: str, from_customer: bool) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "conversation_id": conversation_id,
+        "from_customer": from_customer,
+        "message_text": message_text,
+        "timestamp": datetime.utcnow()
+    }
+
+
+async def resolve_conversation(
+    agency_id: str,
+    customer_id: str | None,
+    whatsapp_phone: str | None,
+    incoming_msg: dict,
+    conversation_id: str | None = None
+) -> tuple[str, list]:
+    """
+    Busca o crea la conversación y la actualiza con el mensaje entrante en
+    un solo viaje a Mongo. No guarda el mensaje en `messages`.
+
+    Con `conversation_id` se actualiza esa conversación; si no, se usa la
+    del cliente (upsert) o, sin cliente, se crea una nueva.
+    Regresa `(conversation_id, historial reciente)`.
+    """
+    now = datetime.utcnow()
+    update = {
+        "$setOnInsert": {
+            "id": conversation_id or str(uuid.uuid4()),
+            "agency_id": agency_id,
+            "customer_id": customer_id,
+            "whatsapp_phone": whatsapp_phone,
+            "created_at": now
+        },
+        "$set": {"last_message": incoming_msg["message_text"], "last_message_at": now},
+        "$push": push_recent(incoming_msg)
+    }
+    if conversation_id:
+        query = {"id": conversation_id}
+    elif customer_id:
+        query = {"agency_id": agency_id, "customer_id": customer_id}
+    else:
+        query = {"id": update["$setOnInsert"]["id"]}
+    # Los campos del filtro se copian solos al insertar
+    for field in query:
+        update["$setOnInsert"].pop(field, None)
+
+    # Se pide el documento ANTES del update: así se distingue una
+    # conversación nueva (None), una con buffer y una previa al buffer
+    projection = {"_id": 0, "id": 1, "recent_messages": 1}
+    try:
+        before = await conversations_collection.find_one_and_update(
+            query, update, projection=projection,
+            upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # Otro upsert creó la conversación primero: se reintenta como update
+        del update["$setOnInsert"]
+        before = await conversations_collection.find_one_and_update(
+            query, update, projection=projection,
+            return_document=ReturnDocument.BEFORE
+        )
+
+    entry = recent_entry(incoming_msg)
+    if before is None:
+        return query.get("id") or update["$setOnInsert"]["id"], [entry]
+    if "recent_messages" in before:
+        return before["id"], (before["recent_messages"] + [entry])[-RECENT_MESSAGES_LIMIT:]
+    return before["id"], await _seed_recent_messages(before["id"], entry)
+
+
+async def _seed_recent_messages(conversation_id: str, entry: dict) -> list:
+    """
+    Conversación anterior al buffer: el upsert solo dejó el mensaje nuevo,
+    así que se llena con los últimos mensajes de `messages`.
+    """
+    previous = await messages_collection.find(
+        {"conversation_id": conversation_id},
+        {"_id": 0}
+    ).sort("timestamp", -1).limit(RECENT_MESSAGES_LIMIT).to_list(RECENT_MESSAGES_LIMIT)
+    previous.reverse()
+    history = ([recent_entry(msg) for msg in previous] + [entry])[-RECENT_MESSAGES_LIMIT:]
+    await conversations_collection.update_one(
+        {"id": conversation_id},
+        {"$set": {"recent_messages": history}}
+    )
+    return history
+
+
+async def record_outbound(
+    conversation_id: str,
+    response_text: str,
+    touch_last_message: bool = True
+) -> dict:
+    """
+    Guarda la respuesta y la agrega a la conversación. Son colecciones
+    distintas, así que las dos escrituras van en paralelo.
+    """
+    outgoing_msg = new_message(conversation_id, response_text, False)
+    update = {"$push": push_recent(outgoing_msg)}
+    if touch_last_message:
+        update["$set"] = {
+            "last_message": response_text,
+            "last_message_at": outgoing_msg["timestamp"]
+        }
+    await asyncio.gather(
+        message_writer.write(outgoing_msg),
+        conversations_collection.update_one({"id": conversation_id}, update)
+    )
+    return outgoing_msg
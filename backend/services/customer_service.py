@@ -2,6 +2,10 @@
 
 import uuid
 from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
 from database import customers_collection
 from models import LeadSource
 
@@ -10,31 +14,34 @@ async def get_or_create_customer(
     *,
     agency_id: str,
     phone: str,
-    source: LeadSource,
+    source: LeadSource | str,
     name: str | None = None,
     email: str | None = None,
 ) -> dict:
     """
-    ÚNICA forma válida de crear / obtener clientes en todo el sistema
-    """
-
-    customer = await customers_collection.find_one({
-        "agency_id": agency_id,
-        "phone": phone
-    })
+    ÚNICA forma válida de crear / obtener clientes en todo el sistema.
 
-    if customer:
-        return customer
-
-    customer = {
-        "id": str(uuid.uuid4()),
-        "agency_id": agency_id,
-        "name": name or "Cliente WhatsApp",
-        "phone": phone,
-        "email": email,
-        "source": source.value,
-        "created_at": datetime.utcnow()
+    Un solo upsert atómico sobre `(agency_id, phone)`: no hay ventana entre
+    buscar e insertar donde dos mensajes simultáneos creen dos clientes.
+    """
+    update = {
+        "$setOnInsert": {
+            "id": str(uuid.uuid4()),
+            "name": name or "Cliente WhatsApp",
+            "email": email,
+            "source": source.value if isinstance(source, LeadSource) else source,
+            "created_at": datetime.utcnow()
+        }
     }
-
-    await customers_collection.insert_one(customer)
-    return customer
+    try:
+        return await customers_collection.find_one_and_update(
+            {"agency_id": agency_id, "phone": phone},
+            update,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Otro upsert ganó la carrera; su documento ya existe
+        return await customers_collection.find_one(
+            {"agency_id": agency_id, "phone": phone}
+        )
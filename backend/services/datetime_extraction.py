@@ -0,0 +1,187 @@
+# services/datetime_extraction.py
+
+import re
+from datetime import date, datetime, time, timedelta
+from typing import Iterable
+
+
+DAYS_MAP = {
+    'lunes': 0, 'martes': 1, 'miércoles': 2, 'miercoles': 2,
+    'jueves': 3, 'viernes': 4, 'sábado': 5, 'sabado': 5, 'domingo': 6
+}
+
+MONTHS_MAP = {
+    'enero': 1,
+    'febrero': 2,
+    'marzo': 3,
+    'abril': 4,
+    'mayo': 5,
+    'junio': 6,
+    'julio': 7,
+    'agosto': 8,
+    'septiembre': 9,
+    'setiembre': 9,
+    'octubre': 10,
+    'noviembre': 11,
+    'diciembre': 12}
+
+# "mañana" como día, no "en la mañana" / "por la mañana"
+_RELATIVE_RE = re.compile(r"\b(pasado\s+mañana|(?<!la\s)mañana|hoy)\b")
+_WEEKDAY_RE = re.compile(r"\b(" + "|".join(DAYS_MAP) + r")\b")
+_MONTH_DATE_RE = re.compile(
+    r"\b(\d{1,2})\s*(?:de\s+)?(" + "|".join(MONTHS_MAP) + r")\b(?:\s+(?:de\s+|del\s+)?(\d{4}))?"
+)
+_NUMERIC_DATE_RE = re.compile(r"\b(\d{1,2})[/-](\d{1,2})(?:[/-](\d{2,4}))?\b")
+
+_PERIOD = r"(a\.?\s?m\.?|p\.?\s?m\.?|hrs?\b|horas?\b)"
+_CLOCK_RE = re.compile(r"\b(\d{1,2}):(\d{2})\s*" + _PERIOD + "?")
+_HOUR_PERIOD_RE = re.compile(r"\b(\d{1,2})\s*" + _PERIOD)
+_A_LAS_RE = re.compile(r"\ba\s+las?\s+(\d{1,2})\b")
+_BARE_HOUR_RE = re.compile(r"\b(\d{1,2})\b")
+_NOON_RE = re.compile(r"\bmedio\s?d[ií]a\b")
+_PART_OF_DAY_RE = re.compile(r"\b(?:de|en|por)\s+la\s+(mañana|tarde|noche)\b")
+
+# Sin am/pm, una hora menor a esta se asume de la tarde (horario de agencia)
+AFTERNOON_CUTOFF = 9
+
+# Sin hora explícita, la cita se agenda a esta hora
+DEFAULT_APPOINTMENT_TIME = time(10, 0)
+
+
+def _resolve_year(day: int, month: int, year: int | None, today: date) -> date | None:
+    if year is not None and year < 100:
+        year += 2000
+    try:
+        candidate = date(year or today.year, month, day)
+    except ValueError:
+        return None
+    # Sin año explícito, una fecha que ya pasó es del año siguiente
+    if year is None and candidate < today:
+        try:
+            candidate = candidate.replace(year=today.year + 1)
+        except ValueError:
+            return None
+    return candidate
+
+
+def _date_with_spans(text: str, now: datetime) -> tuple[date | None, list[tuple[int, int]]]:
+    """
+    Fecha del texto y los tramos con forma de fecha. Una fecha inválida
+    ("31/02") no se usa, pero su tramo tampoco se lee como hora.
+    """
+    today = now.date()
+    spans = []
+
+    match = _MONTH_DATE_RE.search(text)
+    if match:
+        spans.append(match.span())
+        year = int(match.group(3)) if match.group(3) else None
+        found = _resolve_year(int(match.group(1)), MONTHS_MAP[match.group(2)], year, today)
+        if found:
+            return found, spans
+
+    match = _NUMERIC_DATE_RE.search(text)
+    if match:
+        spans.append(match.span())
+        year = int(match.group(3)) if match.group(3) else None
+        found = _resolve_year(int(match.group(1)), int(match.group(2)), year, today)
+        if found:
+            return found, spans
+
+    match = _WEEKDAY_RE.search(text)
+    if match:
+        days_ahead = DAYS_MAP[match.group(1)] - today.weekday()
+        if days_ahead <= 0:
+            days_ahead += 7
+        return today + timedelta(days=days_ahead), spans
+
+    match = _RELATIVE_RE.search(text)
+    if match:
+        word = match.group(1)
+        if word.startswith("pasado"):
+            return today + timedelta(days=2), spans
+        if word == "mañana":
+            return today + timedelta(days=1), spans
+        return today, spans
+
+    return None, spans
+
+
+def _apply_period(hour: int, period: str | None, text: str) -> int:
+    period = (period or "").replace(".", "").replace(" ", "")
+    part_of_day = _PART_OF_DAY_RE.search(text)
+    if not period and part_of_day:
+        period = "am" if part_of_day.group(1) == "mañana" else "pm"
+
+    if period == "pm" and hour < 12:
+        return hour + 12
+    if period == "am" and hour == 12:
+        return 0
+    if not period and hour < AFTERNOON_CUTOFF:
+        return hour + 12
+    return hour
+
+
+def _time_excluding(text: str, excluded: list[tuple[int, int]]) -> time | None:
+    def outside(match) -> bool:
+        return all(match.end() <= start or match.start() >= end for start, end in excluded)
+
+    if _NOON_RE.search(text):
+        return time(12, 0)
+
+    for match in _CLOCK_RE.finditer(text):
+        if outside(match):
+            hour, minute = int(match.group(1)), int(match.group(2))
+            hour = _apply_period(hour, match.group(3), text)
+            if hour < 24 and minute < 60:
+                return time(hour, minute)
+            # "25:00" no es hora, pero sus números tampoco se leen sueltos
+            excluded = [*excluded, match.span()]
+
+    for pattern in (_HOUR_PERIOD_RE, _A_LAS_RE, _BARE_HOUR_RE):
+        for match in pattern.finditer(text):
+            if not outside(match):
+                continue
+            period = match.group(2) if pattern is _HOUR_PERIOD_RE else None
+            hour = _apply_period(int(match.group(1)), period, text)
+            if hour < 24:
+                return time(hour, 0)
+
+    return None
+
+
+def extract_date(text: str, now: datetime | None = None) -> date | None:
+    """
+    Fecha mencionada en el texto: "12 de mayo", "12/05", "viernes",
+    "mañana", "pasado mañana", "hoy".
+    """
+    found, _ = _date_with_spans(text.lower(), now or datetime.utcnow())
+    return found
+
+
+def extract_time(text: str) -> time | None:
+    """
+    Hora mencionada en el texto: "10:30", "4 pm", "a las 5", "17 hrs",
+    "mediodía". Sin am/pm, las horas antes de las 9 se toman como de la tarde.
+    """
+    return _time_excluding(text.lower(), [])
+
+
+def extract_datetime(text: str, now: datetime | None = None) -> tuple[date | None, time | None]:
+    """
+    Fecha y hora del texto en una sola pasada. Los números que forman
+    parte de la fecha ("12 de mayo") no se confunden con la hora.
+    """
+    text = text.lower()
+    found_date, spans = _date_with_spans(text, now or datetime.utcnow())
+    return found_date, _time_excluding(text, spans)
+
+
+def extract_batch(texts: Iterable[str], now: datetime | None = None) -> list[tuple[date | None, time | None]]:
+    """
+    `extract_datetime` sobre muchos textos con la misma referencia de
+    tiempo (para backfills de mensajes históricos).
+    """
+    now = now or datetime.utcnow()
+    return [extract_datetime(text, now) for text in texts]
+
@@ -0,0 +1,186 @@
+# services/gemini_clients.py
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+from google import genai
+
+
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_QUEUE_TIMEOUT = float(os.environ.get("GEMINI_QUEUE_TIMEOUT", "10"))
+
+
+class GeminiOverloadedError(Exception):
+    """
+    No se liberó un lugar para llamar al modelo dentro del tiempo de espera.
+    """
+
+
+class _KeyLimiter:
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+
+
+class GeminiClientRegistry:
+    """
+    Un `genai.Client` por API key, creado bajo demanda y reutilizado entre
+    mensajes. Se descarta cuando la agencia cambia su `gemini_api_key`.
+    """
+
+    def __init__(self):
+        self._clients: dict[str, genai.Client] = {}
+        self._limiters: dict[str, _KeyLimiter] = {}
+        self.created = 0
+        self.hits = 0
+        self.evicted = 0
+        self.setup_ms_total = 0.0
+        self.setup_ms_last = 0.0
+        self.setup_ms_max = 0.0
+
+    def get(self, api_key: str) -> genai.Client:
+        client = self._clients.get(api_key)
+        if client is not None:
+            self.hits += 1
+            return client
+
+        started = time.perf_counter()
+        client = genai.Client(api_key=api_key)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        self.created += 1
+        self.setup_ms_total += elapsed_ms
+        self.setup_ms_last = elapsed_ms
+        self.setup_ms_max = max(self.setup_ms_max, elapsed_ms)
+        self._clients[api_key] = client
+        return client
+
+    def _limiter(self, api_key: str) -> _KeyLimiter:
+        limiter = self._limiters.get(api_key)
+        if limiter is None:
+            limiter = _KeyLimiter(GEMINI_MAX_CONCURRENCY)
+            self._limiters[api_key] = limiter
+        return limiter
+
+    async def generate_content(
+        self,
+        api_key: str,
+        *,
+        model: str,
+        contents: str,
+        config: dict,
+        timeout: float
+    ):
+        """
+        Llama al modelo con la interfaz async nativa del SDK, limitando las
+        llamadas simultáneas por API key. Si no hay lugar en
+        `GEMINI_QUEUE_TIMEOUT` segundos lanza `GeminiOverloadedError`.
+        """
+        async with self._slot(api_key):
+            client = self.get(api_key)
+            return await asyncio.wait_for(
+                client.aio.models.generate_content(
+                    model=model,
+                    contents=contents,
+                    config=config
+                ),
+                timeout=timeout
+            )
+
+    async def generate_content_stream(
+        self,
+        api_key: str,
+        *,
+        model: str,
+        contents: str,
+        config: dict,
+        timeout: float
+    ):
+        """
+        Versión streaming de `generate_content`: entrega los chunks del
+        modelo. `timeout` aplica a toda la respuesta.
+        """
+        async with self._slot(api_key):
+            client = self.get(api_key)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            stream = await asyncio.wait_for(
+                client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=config
+                ),
+                timeout=timeout
+            )
+            iterator = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        iterator.__anext__(),
+                        timeout=max(0.0, deadline - loop.time())
+                    )
+                except StopAsyncIteration:
+                    break
+                yield chunk
+
+    @asynccontextmanager
+    async def _slot(self, api_key: str):
+        """
+        Ocupa un lugar del límite de concurrencia de la API key.
+        """
+        limiter = self._limiter(api_key)
+        limiter.queued += 1
+        try:
+            await asyncio.wait_for(limiter.semaphore.acquire(), GEMINI_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            limiter.rejected += 1
+            raise GeminiOverloadedError(
+                f"{GEMINI_MAX_CONCURRENCY} Gemini calls in flight for this key"
+            )
+        finally:
+            limiter.queued -= 1
+
+        limiter.in_flight += 1
+        try:
+            yield
+        finally:
+            limiter.in_flight -= 1
+            limiter.semaphore.release()
+
+    def evict(self, api_key: str | None) -> None:
+        # Las llamadas en curso conservan su referencia; solo se deja de reutilizar
+        if api_key and self._clients.pop(api_key, None) is not None:
+            self.evicted += 1
+        if api_key:
+            self._limiters.pop(api_key, None)
+
+    async def close_all(self) -> None:
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            try:
+                await client.aio.aclose()
+                client.close()
+            except Exception as e:
+                print(f"Error closing Gemini client: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self._clients),
+            "created": self.created,
+            "hits": self.hits,
+            "evicted": self.evicted,
+            "setup_ms_last": round(self.setup_ms_last, 2),
+            "setup_ms_max": round(self.setup_ms_max, 2),
+            "setup_ms_avg": round(self.setup_ms_total / self.created, 2) if self.created else 0.0,
+            "in_flight": sum(limiter.in_flight for limiter in self._limiters.values()),
+            "queued": sum(limiter.queued for limiter in self._limiters.values()),
+            "rejected": sum(limiter.rejected for limiter in self._limiters.values())
+        }
+
+
+gemini_clients = GeminiClientRegistry()
@@ -0,0 +1,92 @@
+# services/indexes.py
+
+from pymongo import ASCENDING, DESCENDING
+
+from database import db
+from services.message_dedup import DEDUP_TTL_SECONDS
+
+
+class IndexSpec:
+    """
+    Un índice declarado: colección, llaves y opciones de `create_index`.
+    """
+
+    def __init__(self, collection: str, keys: list[tuple[str, int]], **options):
+        self.collection = collection
+        self.keys = keys
+        self.options = options
+
+    def describe(self) -> str:
+        keys = ", ".join(f"{field}:{direction}" for field, direction in self.keys)
+        return f"{self.collection}({keys})"
+
+
+# Registro único de índices. Cada consulta de las rutas y servicios debe
+# tener aquí un índice que la cubra (ver scripts/audit_query_plans.py).
+INDEXES = [
+    IndexSpec("users", [("id", ASCENDING)], unique=True),
+    IndexSpec("users", [("email", ASCENDING)], unique=True),
+
+    IndexSpec("agencies", [("id", ASCENDING)], unique=True),
+    IndexSpec("agencies", [("is_active", ASCENDING)]),
+
+    IndexSpec("cars", [("id", ASCENDING)], unique=True),
+    IndexSpec("cars", [("agency_id", ASCENDING), ("is_available", ASCENDING)]),
+    IndexSpec("cars", [("agency_id", ASCENDING), ("brand", ASCENDING)]),
+
+    IndexSpec("media_files", [("id", ASCENDING)], unique=True),
+    IndexSpec("media_files", [("agency_id", ASCENDING), ("category", ASCENDING)]),
+    IndexSpec("media_files", [("related_id", ASCENDING)]),
+
+    IndexSpec("promotions", [("id", ASCENDING)], unique=True),
+    IndexSpec("promotions", [("agency_id", ASCENDING), ("is_active", ASCENDING)]),
+
+    IndexSpec("customers", [("id", ASCENDING)], unique=True),
+    IndexSpec("customers", [("agency_id", ASCENDING), ("phone", ASCENDING)], unique=True),
+    IndexSpec("customers", [("agency_id", ASCENDING), ("source", ASCENDING)]),
+
+    IndexSpec("appointments", [("id", ASCENDING)], unique=True),
+    IndexSpec("appointments", [
+        ("agency_id", ASCENDING), ("appointment_date", ASCENDING), ("status", ASCENDING)
+    ]),
+    IndexSpec("appointments", [("status", ASCENDING), ("deleted_at", ASCENDING)]),
+
+    IndexSpec("conversations", [("id", ASCENDING)], unique=True),
+    # Una conversación por cliente; las de test chat sin cliente no cuentan
+    IndexSpec(
+        "conversations",
+        [("agency_id", ASCENDING), ("customer_id", ASCENDING)],
+        unique=True,
+        partialFilterExpression={"customer_id": {"$type": "string"}}
+    ),
+    IndexSpec("conversations", [("agency_id", ASCENDING), ("last_message_at", DESCENDING)]),
+
+    IndexSpec("messages", [("id", ASCENDING)], unique=True),
+    IndexSpec("messages", [("conversation_id", ASCENDING), ("timestamp", ASCENDING)]),
+
+    IndexSpec("system_config", [("agency_id", ASCENDING)]),
+
+    IndexSpec("processed_messages", [("message_id", ASCENDING)], unique=True),
+    IndexSpec("processed_messages", [("created_at", ASCENDING)], expireAfterSeconds=DEDUP_TTL_SECONDS),
+
+    IndexSpec("outbox", [("id", ASCENDING)], unique=True),
+    IndexSpec("outbox", [("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+]
+
+
+async def apply_indexes(database=None) -> dict:
+    """
+    Crea todos los índices de `INDEXES`. Es idempotente: los que ya existen
+    no cambian. Un índice que falla (ej. duplicados en datos viejos) no
+    detiene a los demás.
+    """
+    database = database if database is not None else db
+    applied, failed = 0, []
+    for spec in INDEXES:
+        try:
+            await database[spec.collection].create_index(spec.keys, **spec.options)
+            applied += 1
+        except Exception as e:
+            failed.append(spec.describe())
+            print(f"Error creating index {spec.describe()}: {e}")
+    return {"applied": applied, "failed": failed}
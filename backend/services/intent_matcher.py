@@ -0,0 +1,89 @@
+# services/intent_matcher.py
+
+import re
+
+
+# Palabras clave por intención. Se comparan como palabras completas; un
+# "*" al final acepta cualquier terminación (agend* -> agendar, agendo...).
+INTENT_KEYWORDS = {
+    # Intención de ir a la agencia (creación automática de citas)
+    "visit": [
+        "cita", "citas", "agend*", "reserv*", "apart*", "ir", "visit*",
+        "voy", "iré", "ire", "paso", "llego",
+    ],
+    "time_reference": [
+        "hora", "horas", "hoy", "mañana", "tarde", "lunes", "martes",
+        "miércoles", "miercoles", "jueves", "viernes", "sábado", "sabado",
+        "domingo",
+    ],
+    "greeting": ["hola", "buenos", "buenas", "hi", "hey"],
+    "cars": [
+        "auto", "autos", "carro", "carros", "vehículo", "vehículos",
+        "vehiculo", "vehiculos",
+    ],
+    "promotions": [
+        "promoción", "promocion", "promociones", "oferta", "ofertas",
+        "descuento", "descuentos",
+    ],
+    "appointment": ["cita", "citas", "agend*", "visit*"],
+    "pricing": ["precio", "precios", "costo", "costos", "cuanto", "cuánto"],
+    "location": [
+        "horario", "horarios", "ubicación", "ubicacion", "direccion",
+        "dirección", "donde", "dónde",
+    ],
+    # Preguntas frecuentes que no dependen del cliente (ver response_cache)
+    "hours": ["horario", "horarios", "abren", "cierran", "abierto", "abiertos"],
+    "financing": [
+        "financiamiento", "financiar", "crédito", "credito", "enganche",
+        "mensualidad", "mensualidades",
+    ],
+    "thanks": ["gracias", "ok", "vale", "perfecto"],
+}
+
+
+_WORD = re.compile(r"\w+")
+
+
+class IntentMatcher:
+    """
+    Clasifica un mensaje contra todas las intenciones en una sola pasada.
+
+    Las palabras clave se indexan una vez en un dict palabra -> intenciones
+    (y una tupla de prefijos para las que terminan en "*"); el mensaje se
+    parte en palabras con un regex compilado y cada palabra se resuelve con
+    un lookup. Comparar palabras completas evita que "ir" o "ok" se activen
+    dentro de otras palabras.
+    """
+
+    def __init__(self, intents: dict[str, list[str]]):
+        self.intents = list(intents)
+        self._exact: dict[str, frozenset[str]] = {}
+        prefixes: dict[str, set[str]] = {}
+        for intent, keywords in intents.items():
+            for keyword in keywords:
+                keyword = keyword.lower()
+                if keyword.endswith("*"):
+                    prefixes.setdefault(keyword[:-1], set()).add(intent)
+                else:
+                    self._exact[keyword] = self._exact.get(keyword, frozenset()) | {intent}
+        self._prefixes = {prefix: frozenset(found) for prefix, found in prefixes.items()}
+        self._prefix_tuple = tuple(self._prefixes)
+
+    def classify(self, text: str) -> set[str]:
+        found: set[str] = set()
+        exact = self._exact
+        for word in _WORD.findall(text.lower()):
+            intents = exact.get(word)
+            if intents:
+                found |= intents
+            if word.startswith(self._prefix_tuple):
+                for prefix, prefix_intents in self._prefixes.items():
+                    if word.startswith(prefix):
+                        found |= prefix_intents
+        return found
+
+    def matches(self, text: str, intent: str) -> bool:
+        return intent in self.classify(text)
+
+
+intent_matcher = IntentMatcher(INTENT_KEYWORDS)
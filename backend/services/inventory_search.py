@@ -0,0 +1,156 @@
+# services/inventory_search.py
+
+import os
+import re
+import unicodedata
+from collections import defaultdict
+
+
+PROMPT_CARS_TOP_K = int(os.environ.get("PROMPT_CARS_TOP_K", "10"))
+PROMPT_CARS_TOKEN_BUDGET = int(os.environ.get("PROMPT_CARS_TOKEN_BUDGET", "400"))
+
+# Peso de cada campo al rankear
+FIELD_WEIGHTS = {"brand": 3.0, "model": 3.0, "year": 2.0, "description": 1.0}
+
+_WORD = re.compile(r"[a-z0-9]+")
+_MIL = re.compile(r"(\d+(?:[.,]\d+)?)\s*(mil|k)\b")
+
+STOPWORDS = {
+    "de", "la", "el", "los", "las", "un", "una", "unos", "unas", "y", "o",
+    "en", "con", "por", "para", "que", "del", "al", "me", "mi", "tu", "su",
+    "se", "es", "hay", "tienen", "tiene", "busco", "quiero", "algun",
+    "alguna", "auto", "autos", "carro", "carros", "coche", "vehiculo",
+    "vehiculos", "hola", "precio", "cuanto", "cuesta", "como", "mas", "menos",
+}
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def _stem(token: str) -> str:
+    # Plurales simples en español: sedanes -> sedan, camionetas -> camioneta
+    if len(token) > 4 and token.endswith("es") and token[-3] not in "aeiou":
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> list[str]:
+    return [
+        _stem(token) for token in _WORD.findall(_normalize(text))
+        if token not in STOPWORDS
+    ]
+
+
+def _within_distance(a: str, b: str, max_distance: int) -> bool:
+    """
+    Levenshtein acotado: corta en cuanto la distancia supera el máximo.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)
+            ))
+        if min(current) > max_distance:
+            return False
+        previous = current
+    return previous[-1] <= max_distance
+
+
+def _extract_budget(text: str) -> float | None:
+    text = _normalize(text)
+    match = _MIL.search(text)
+    if match:
+        return float(match.group(1).replace(",", ".")) * 1000
+    amounts = [
+        float(n.replace(",", "")) for n in re.findall(r"\$?\s*(\d{1,3}(?:,\d{3})+|\d{5,})", text)
+    ]
+    return max(amounts) if amounts else None
+
+
+class InventoryIndex:
+    """
+    Índice invertido en memoria sobre marca, modelo, año, precio y
+    descripción de los autos de una agencia, con tolerancia a errores de
+    dedo (distancia de edición 1-2 según el largo de la palabra).
+    """
+
+    def __init__(self, cars: list[dict]):
+        self.cars = cars
+        self._postings: dict[str, dict[int, float]] = defaultdict(dict)
+        for index, car in enumerate(cars):
+            for field, weight in FIELD_WEIGHTS.items():
+                for token in tokenize(car.get(field) or ""):
+                    postings = self._postings[token]
+                    postings[index] = max(postings.get(index, 0.0), weight)
+        self._fuzzy_cache: dict[str, list[str]] = {}
+
+    def _expand(self, token: str) -> list[tuple[str, float]]:
+        if token in self._postings:
+            return [(token, 1.0)]
+        if len(token) < 4 or token.isdigit():
+            return []
+        if token not in self._fuzzy_cache:
+            max_distance = 1 if len(token) < 7 else 2
+            self._fuzzy_cache[token] = [
+                term for term in self._postings
+                if not term.isdigit() and _within_distance(token, term, max_distance)
+            ]
+        return [(term, 0.7) for term in self._fuzzy_cache[token]]
+
+    def search(self, query: str, k: int = PROMPT_CARS_TOP_K) -> list[dict]:
+        scores: dict[int, float] = defaultdict(float)
+        for token in set(tokenize(query)):
+            for term, factor in self._expand(token):
+                for index, weight in self._postings[term].items():
+                    scores[index] += weight * factor
+
+        budget = _extract_budget(query)
+        if budget:
+            for index, car in enumerate(self.cars):
+                price = car.get("price")
+                if price and price <= budget:
+                    # Más cerca del presupuesto, más relevante
+                    scores[index] += 1.0 + price / budget
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [self.cars[index] for index, _ in ranked[:k]]
+
+
+def format_car_line(car: dict) -> str:
+    line = f"\n- {car.get('brand', '')} {car.get('model', '')} {car.get('year', '')}"
+    if car.get('price'):
+        line += f" - ${car['price']:,.2f}"
+    return line
+
+
+def build_inventory_context(
+    index: InventoryIndex,
+    query: str,
+    k: int = PROMPT_CARS_TOP_K,
+    token_budget: int = PROMPT_CARS_TOKEN_BUDGET
+) -> str:
+    """
+    Líneas de inventario para el prompt: los `k` autos más relevantes para
+    el mensaje (o los primeros del inventario si nada coincide), cortando
+    al llegar al presupuesto aproximado de tokens (~4 caracteres por token).
+    """
+    cars = index.search(query, k) or index.cars[:k]
+    context = ""
+    used_tokens = 0
+    for car in cars:
+        line = format_car_line(car)
+        used_tokens += len(line) // 4 + 1
+        if used_tokens > token_budget:
+            break
+        context += line
+    return context
@@ -0,0 +1,88 @@
+# services/message_coalescer.py
+
+import asyncio
+import os
+from typing import Awaitable, Callable
+
+
+# Sin `message_debounce_ms` en la agencia no se agrupa (0 = responder de inmediato)
+DEFAULT_DEBOUNCE_MS = int(os.environ.get("DEFAULT_MESSAGE_DEBOUNCE_MS", "0"))
+# Una ráfaga nunca espera más de N ventanas, aunque el cliente siga escribiendo
+DEBOUNCE_MAX_WINDOWS = int(os.environ.get("MESSAGE_DEBOUNCE_MAX_WINDOWS", "4"))
+
+
+FlushCallback = Callable[[str], Awaitable[None]]
+
+
+class _Burst:
+    def __init__(self, on_flush: FlushCallback, deadline: float):
+        self.texts: list[str] = []
+        self.on_flush = on_flush
+        self.deadline = deadline
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class MessageCoalescer:
+    """
+    Junta los mensajes seguidos de una conversación en un solo turno.
+
+    Cada mensaje reinicia la ventana de espera; cuando la ventana vence
+    (o se alcanza el máximo) se llama `on_flush` con el texto unido.
+    """
+
+    def __init__(self):
+        self._bursts: dict[str, _Burst] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.merged_messages = 0
+        self.flushed_turns = 0
+
+    def add(self, key: str, text: str, window_ms: int, on_flush: FlushCallback) -> None:
+        loop = asyncio.get_running_loop()
+        window = window_ms / 1000
+        burst = self._bursts.get(key)
+        if burst is None:
+            burst = _Burst(on_flush, loop.time() + window * DEBOUNCE_MAX_WINDOWS)
+            self._bursts[key] = burst
+        else:
+            burst.timer.cancel()
+            self.merged_messages += 1
+
+        burst.texts.append(text)
+        burst.on_flush = on_flush
+        delay = max(0.0, min(window, burst.deadline - loop.time()))
+        burst.timer = loop.call_later(delay, self._fire, key)
+
+    def _fire(self, key: str) -> None:
+        burst = self._bursts.pop(key, None)
+        if burst is None:
+            return
+        task = asyncio.create_task(self._flush(burst))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, burst: _Burst) -> None:
+        self.flushed_turns += 1
+        try:
+            await burst.on_flush("\n".join(burst.texts))
+        except Exception as e:
+            print(f"Error flushing message burst: {e}")
+
+    async def flush_all(self) -> None:
+        """
+        Dispara todas las ráfagas pendientes (se usa al apagar).
+        """
+        for key in list(self._bursts):
+            self._bursts[key].timer.cancel()
+            self._fire(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending_bursts": len(self._bursts),
+            "merged_messages": self.merged_messages,
+            "flushed_turns": self.flushed_turns
+        }
+
+
+message_coalescer = MessageCoalescer()
@@ -0,0 +1,97 @@
+# services/message_dedup.py
+
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from database import processed_messages_collection
+
+
+DEDUP_TTL_SECONDS = int(os.environ.get("WHATSAPP_DEDUP_TTL", "86400"))
+DEDUP_MAX_ENTRIES = int(os.environ.get("WHATSAPP_DEDUP_MAX_ENTRIES", "100000"))
+
+
+class MessageDeduplicator:
+    """
+    Descarta reentregas de Meta usando el id del mensaje de WhatsApp.
+
+    Primero revisa un set en memoria con TTL (O(1), sin tocar la DB) y
+    después reclama el id en `processed_messages`, que tiene índice único,
+    para cubrir reinicios y varios procesos.
+    """
+
+    def __init__(self, ttl: int = DEDUP_TTL_SECONDS, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen: OrderedDict[str, float] = OrderedDict()
+        self.dropped = 0
+
+    def _evict(self, now: float) -> None:
+        while self._seen:
+            oldest_id, expires_at = next(iter(self._seen.items()))
+            if expires_at > now and len(self._seen) < self.max_entries:
+                break
+            self._seen.pop(oldest_id)
+
+    def remember(self, message_id: str | None) -> bool:
+        """
+        Marca el id en memoria. Regresa False si ya se había visto.
+        """
+        if not message_id:
+            return True
+        now = time.monotonic()
+        self._evict(now)
+        expires_at = self._seen.get(message_id)
+        if expires_at and expires_at > now:
+            self.dropped += 1
+            return False
+        self._seen[message_id] = now + self.ttl
+        self._seen.move_to_end(message_id)
+        return True
+
+    def forget(self, message_id: str | None) -> None:
+        """
+        Quita el id de memoria para aceptar la reentrega.
+        """
+        if message_id:
+            self._seen.pop(message_id, None)
+
+    async def claim(self, message_id: str | None) -> bool:
+        """
+        Reclama el id en Mongo. Regresa False si otro proceso ya lo procesó.
+        """
+        if not message_id:
+            return True
+        try:
+            await processed_messages_collection.insert_one({
+                "message_id": message_id,
+                "created_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            self.dropped += 1
+            return False
+        except Exception as e:
+            print(f"Error claiming WhatsApp message {message_id}: {e}")
+        return True
+
+    async def release(self, message_id: str | None) -> None:
+        """
+        Suelta el id reclamado (memoria y Mongo) cuando procesarlo falló,
+        para que una reentrega sí se procese.
+        """
+        if not message_id:
+            return
+        self.forget(message_id)
+        try:
+            await processed_messages_collection.delete_one({"message_id": message_id})
+        except Exception as e:
+            print(f"Error releasing WhatsApp message {message_id}: {e}")
+
+    def stats(self) -> dict:
+        return {"cached_ids": len(self._seen), "dropped": self.dropped}
+
+
+message_dedup = MessageDeduplicator()
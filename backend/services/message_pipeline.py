@@ -0,0 +1,337 @@
+# services/message_pipeline.py
+
+import asyncio
+import bisect
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable
+
+from models import LeadSource
+from services.customer_service import get_or_create_customer
+from services.conversation_store import new_message, resolve_conversation, record_outbound
+from services.message_writer import message_writer
+from services.agency_context import agency_context
+
+
+STAGES = (
+    "resolve_customer",
+    "resolve_conversation",
+    "persist_inbound",
+    "detect_intent",
+    "generate_reply",
+    "persist_outbound",
+    "send",
+)
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """
+    Histograma de latencias con buckets fijos (ms).
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> float:
+        """
+        Límite superior del bucket donde cae el percentil `q`.
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return float(self.buckets[index]) if index < len(self.buckets) else self.max_ms
+        return self.max_ms
+
+    def stats(self) -> dict:
+        labels = [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": round(self.max_ms, 2),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class PipelineMetrics:
+    """
+    Latencia por etapa del pipeline, sin importar el canal.
+    """
+
+    def __init__(self):
+        self._histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self._failures = {stage: 0 for stage in STAGES}
+
+    @asynccontextmanager
+    async def stage(self, name: str) -> AsyncIterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self._failures[name] += 1
+            raise
+        finally:
+            self._histograms[name].observe((time.perf_counter() - started) * 1000)
+
+    def stats(self) -> dict:
+        return {
+            stage: {**histogram.stats(), "failures": self._failures[stage]}
+            for stage, histogram in self._histograms.items()
+        }
+
+
+pipeline_metrics = PipelineMetrics()
+
+
+class MessageTurn:
+    """
+    Un mensaje entrante y lo que se va sabiendo de él en cada etapa.
+    """
+
+    def __init__(self, *, agency_id: str, channel: str, message_text: str,
+                 phone: str | None = None, conversation_id: str | None = None,
+                 source: LeadSource | str = LeadSource.WHATSAPP,
+                 customer_name: str | None = None, whatsapp_phone: str | None = None):
+        self.agency_id = agency_id
+        self.channel = channel
+        self.message_text = message_text
+        self.phone = phone
+        self.source = source
+        self.customer_name = customer_name
+        self.whatsapp_phone = whatsapp_phone
+        self.customer_id: str | None = None
+        self.conversation_id = conversation_id
+        self.history: list | None = None
+        self.incoming: dict | None = None
+        self.intent = None
+        self.response_text: str | None = None
+        self.outgoing: dict | None = None
+        # Se marca al guardar el mensaje entrante; los efectos que deben
+        # quedar después de él (ej. crear la cita) lo esperan
+        self.inbound_saved = asyncio.Event()
+
+    def follow_up(self, message_text: str) -> "MessageTurn":
+        """
+        Turno para responder `message_text` en la misma conversación, sin
+        volver a guardarlo (ej. una ráfaga ya guardada mensaje por mensaje).
+        """
+        turn = MessageTurn(
+            agency_id=self.agency_id,
+            channel=self.channel,
+            message_text=message_text,
+            phone=self.phone,
+            conversation_id=self.conversation_id,
+            source=self.source,
+            customer_name=self.customer_name,
+            whatsapp_phone=self.whatsapp_phone,
+        )
+        turn.customer_id = self.customer_id
+        turn.inbound_saved.set()
+        return turn
+
+
+Step = tuple[tuple[str, ...], Callable[[], Awaitable[object]]]
+
+
+async def _cancel_all(tasks) -> None:
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_graph(steps: dict[str, Step]) -> dict[str, object]:
+    """
+    Ejecuta `{nombre: (dependencias, fn)}`: cada paso arranca en cuanto
+    terminan sus dependencias, así las ramas independientes corren en
+    paralelo. Si un paso falla se cancelan los demás y se relanza el error.
+    """
+    tasks: dict[str, asyncio.Task] = {}
+
+    async def run_step(name: str):
+        dependencies, fn = steps[name]
+        if dependencies:
+            await asyncio.gather(*(tasks[dependency] for dependency in dependencies))
+        return await fn()
+
+    for name in steps:
+        tasks[name] = asyncio.create_task(run_step(name), name=f"pipeline-{name}")
+
+    try:
+        done, pending = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+        await _cancel_all(tasks.values())
+        raise
+
+    failed = next((task for task in done if not task.cancelled() and task.exception()), None)
+    if failed is not None:
+        await _cancel_all(pending)
+        raise failed.exception()
+    return {name: task.result() for name, task in tasks.items()}
+
+
+DetectIntent = Callable[[MessageTurn], Awaitable[object]]
+GenerateReply = Callable[[MessageTurn], Awaitable[str]]
+SendReply = Callable[[MessageTurn], Awaitable[None]]
+Prefetch = Callable[[MessageTurn], Awaitable[object]]
+
+
+async def load_agency_context(turn: MessageTurn):
+    """
+    Prefetch común a los canales: calienta el snapshot de la agencia
+    mientras se guarda el mensaje.
+    """
+    return await agency_context.get(turn.agency_id)
+
+
+class MessagePipeline:
+    """
+    Manejo de un mensaje en etapas fijas, igual para todos los canales:
+
+    resolve_customer → resolve_conversation → persist_inbound →
+    detect_intent → generate_reply → persist_outbound → send
+
+    Cada canal solo aporta cómo detectar la intención, cómo generar la
+    respuesta, (opcional) cómo enviarla y qué precargar en paralelo (ej. el
+    contexto de la agencia). Cada etapa se mide en `pipeline_metrics`.
+
+    `run()` ejecuta las etapas como grafo de dependencias: guardar el
+    mensaje entrante corre junto con la detección y la generación de la
+    respuesta, y la precarga corre desde el inicio. Lo único que espera al
+    mensaje guardado es crear la cita (`turn.inbound_saved`): si guardarlo
+    falla se cancela todo y no queda una cita sin su mensaje.
+    """
+
+    def __init__(self, *, detect_intent: DetectIntent, generate_reply: GenerateReply,
+                 send: SendReply | None = None, prefetch: Prefetch | None = None,
+                 touch_last_message: bool = True):
+        self.detect_intent = detect_intent
+        self.generate_reply = generate_reply
+        self.send = send
+        self.prefetch = prefetch
+        self.touch_last_message = touch_last_message
+
+    async def run(self, turn: MessageTurn) -> MessageTurn:
+        await run_graph({
+            **self._receive_steps(turn),
+            "generate_reply": (("detect_intent", "prefetch"), partial(self._generate, turn)),
+            "finish": (("generate_reply", "persist_inbound"), partial(self.finish, turn)),
+        })
+        return turn
+
+    async def prepare(self, turn: MessageTurn) -> MessageTurn:
+        """
+        Todo lo previo a generar la respuesta (para quien la genera aparte,
+        como el streaming).
+        """
+        await run_graph(self._receive_steps(turn))
+        return turn
+
+    async def receive(self, turn: MessageTurn) -> MessageTurn:
+        """
+        Cliente, conversación y mensaje entrante.
+        """
+        await self._resolve_customer(turn)
+        await self._resolve_conversation(turn)
+        await self._persist_inbound(turn)
+        return turn
+
+    async def respond(self, turn: MessageTurn) -> MessageTurn:
+        """
+        Responde un turno ya recibido.
+        """
+        await run_graph({
+            "prefetch": ((), partial(self._prefetch, turn)),
+            "detect_intent": ((), partial(self.detect, turn)),
+            "generate_reply": (("detect_intent", "prefetch"), partial(self._generate, turn)),
+            "finish": (("generate_reply",), partial(self.finish, turn)),
+        })
+        return turn
+
+    def _receive_steps(self, turn: MessageTurn) -> dict[str, Step]:
+        return {
+            "prefetch": ((), partial(self._prefetch, turn)),
+            "resolve_customer": ((), partial(self._resolve_customer, turn)),
+            "resolve_conversation": (("resolve_customer",), partial(self._resolve_conversation, turn)),
+            "persist_inbound": (("resolve_conversation",), partial(self._persist_inbound, turn)),
+            "detect_intent": (("resolve_conversation",), partial(self.detect, turn)),
+        }
+
+    async def _prefetch(self, turn: MessageTurn) -> None:
+        if not self.prefetch:
+            return
+        try:
+            await self.prefetch(turn)
+        except Exception as e:
+            # Solo es una precarga: la etapa que lo necesite lo volverá a pedir
+            print(f"Error prefetching for pipeline: {e}")
+
+    async def _resolve_customer(self, turn: MessageTurn) -> None:
+        if not turn.phone or turn.customer_id:
+            return
+        async with pipeline_metrics.stage("resolve_customer"):
+            customer = await get_or_create_customer(
+                agency_id=turn.agency_id,
+                phone=turn.phone,
+                source=turn.source,
+                name=turn.customer_name
+            )
+            turn.customer_id = customer["id"]
+
+    async def _resolve_conversation(self, turn: MessageTurn) -> None:
+        turn.incoming = new_message(turn.conversation_id, turn.message_text, True)
+        async with pipeline_metrics.stage("resolve_conversation"):
+            turn.conversation_id, turn.history = await resolve_conversation(
+                turn.agency_id,
+                turn.customer_id,
+                turn.whatsapp_phone,
+                turn.incoming,
+                turn.conversation_id
+            )
+        turn.incoming["conversation_id"] = turn.conversation_id
+
+    async def _persist_inbound(self, turn: MessageTurn) -> None:
+        async with pipeline_metrics.stage("persist_inbound"):
+            await message_writer.write(turn.incoming)
+        turn.inbound_saved.set()
+
+    async def detect(self, turn: MessageTurn) -> MessageTurn:
+        async with pipeline_metrics.stage("detect_intent"):
+            turn.intent = await self.detect_intent(turn)
+        return turn
+
+    async def _generate(self, turn: MessageTurn) -> None:
+        async with pipeline_metrics.stage("generate_reply"):
+            turn.response_text = await self.generate_reply(turn)
+
+    async def finish(self, turn: MessageTurn) -> MessageTurn:
+        """
+        Guarda `turn.response_text` y lo envía por el canal.
+        """
+        async with pipeline_metrics.stage("persist_outbound"):
+            turn.outgoing = await record_outbound(
+                turn.conversation_id,
+                turn.response_text,
+                touch_last_message=self.touch_last_message
+            )
+        if self.send:
+            async with pipeline_metrics.stage("send"):
+                await self.send(turn)
+        return turn
@@ -0,0 +1,136 @@
+# services/message_writer.py
+
+import asyncio
+import os
+
+from pymongo.errors import BulkWriteError
+
+from database import messages_collection
+from services.request_db_metrics import RequestDbStats, current_db_stats, shared_db_scope
+
+
+MESSAGE_FLUSH_MS = int(os.environ.get("MESSAGE_FLUSH_MS", "5"))
+MESSAGE_BATCH_SIZE = int(os.environ.get("MESSAGE_BATCH_SIZE", "200"))
+
+
+class MessageWriter:
+    """
+    Group commit para `messages`: junta los documentos que llegan de
+    requests concurrentes y los escribe con un solo
+    `insert_many(ordered=False)` cada `flush_ms` o al llenar `batch_size`.
+
+    `write()` regresa cuando el documento ya quedó guardado (o lanza el
+    error de ese documento). Si el writer no está corriendo escribe directo.
+    El insert de cada batch se cuenta en las estadísticas de Mongo de los
+    requests (o trabajos) que tienen documentos en él.
+    """
+
+    def __init__(self, flush_ms: int = MESSAGE_FLUSH_MS, batch_size: int = MESSAGE_BATCH_SIZE):
+        self.flush_interval = flush_ms / 1000
+        self.batch_size = max(1, batch_size)
+        self._pending: list[tuple[dict, asyncio.Future, RequestDbStats | None]] = []
+        self._has_items: asyncio.Event | None = None
+        self._full: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self._batches = 0
+        self._written = 0
+        self._failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._has_items = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(), name="message-writer")
+
+    async def stop(self) -> None:
+        """
+        Escribe todo lo pendiente y detiene el writer.
+        """
+        if not self.running:
+            return
+        self._stopping = True
+        self._has_items.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+    async def write(self, document: dict) -> None:
+        if not self.running or self._stopping:
+            await messages_collection.insert_one(document)
+            self._written += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((document, future, current_db_stats()))
+        self._has_items.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        await future
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_items.wait()
+            if not self._stopping:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            while self._pending:
+                await self._flush()
+                if not self._stopping:
+                    break
+            if not self._pending:
+                self._has_items.clear()
+                if self._stopping:
+                    return
+            if len(self._pending) < self.batch_size:
+                self._full.clear()
+
+    async def _flush(self) -> None:
+        batch = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+        documents = [document for document, _, _ in batch]
+        scopes = list({id(stats): stats for _, _, stats in batch if stats is not None}.values())
+        failed: dict[int, Exception] = {}
+
+        try:
+            with shared_db_scope(scopes):
+                await messages_collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                failed[write_error["index"]] = e
+            print(f"Error writing message batch: {len(failed)} de {len(batch)} fallaron")
+        except Exception as e:
+            failed = {index: e for index in range(len(batch))}
+            print(f"Error writing message batch: {e}")
+
+        self._batches += 1
+        self._failed += len(failed)
+        self._written += len(batch) - len(failed)
+        for index, (_, future, _) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending": len(self._pending),
+            "batches": self._batches,
+            "written": self._written,
+            "failed": self._failed,
+            "avg_batch_size": round(self._written / self._batches, 2) if self._batches else 0.0,
+        }
+
+
+message_writer = MessageWriter()
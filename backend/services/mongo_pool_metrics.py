@@ -0,0 +1,91 @@
+# services/mongo_pool_metrics.py
+
+import threading
+import time
+
+from pymongo import monitoring
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Métricas del pool de conexiones de Mongo a partir de los eventos CMAP.
+
+    Motor ejecuta pymongo en hilos, así que los contadores usan un lock y
+    el inicio de cada checkout se guarda por hilo para medir la espera.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.open_connections = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures: dict[str, int] = {}
+        self.pool_clears = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    # Checkouts
+    def connection_check_out_started(self, event):
+        self._local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        waited = time.monotonic() - getattr(self._local, "started", time.monotonic())
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            reason = str(event.reason)
+            self.checkout_failures[reason] = self.checkout_failures.get(reason, 0) + 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    # Conexiones
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    # Pool
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": dict(self.checkout_failures),
+                "pool_clears": self.pool_clears,
+                "avg_wait_ms": round(self._total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self._max_wait * 1000, 3),
+            }
+
+
+mongo_pool_metrics = PoolMetricsListener()
@@ -0,0 +1,326 @@
+# services/outbox.py
+
+import asyncio
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+from pymongo import ReturnDocument
+
+from database import outbox_collection, messages_collection
+from services.whatsapp_client import whatsapp_client
+
+
+OUTBOX_SEND_RATE = float(os.environ.get("WHATSAPP_SEND_RATE", "20"))
+OUTBOX_SEND_BURST = int(os.environ.get("WHATSAPP_SEND_BURST", "40"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", "300"))
+OUTBOX_CONCURRENCY = int(os.environ.get("OUTBOX_CONCURRENCY", "10"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_LEASE_SECONDS = int(os.environ.get("OUTBOX_LEASE_SECONDS", "60"))
+
+
+class OutboxStatus:
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+class TokenBucket:
+    """
+    Token bucket simple: `rate` tokens por segundo, hasta `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryableSendError(Exception):
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after_seconds(response: httpx.Response) -> float | None:
+    """
+    `Retry-After` en segundos, si la Graph API lo manda.
+    """
+    try:
+        return max(0.0, float(response.headers.get("retry-after", "")))
+    except ValueError:
+        return None
+
+
+def _whatsapp_message_id(response: httpx.Response) -> str | None:
+    # Un 2xx ya es un envío hecho aunque el cuerpo no sea el esperado
+    try:
+        payload = response.json()
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None
+    messages = payload.get("messages")
+    if not isinstance(messages, list) or not messages or not isinstance(messages[0], dict):
+        return None
+    return messages[0].get("id")
+
+
+def _backoff_seconds(attempts: int) -> float:
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE ** attempts)
+    return delay * random.uniform(0.5, 1.0)
+
+
+async def enqueue_outbound(
+    *,
+    agency_id: str,
+    to_phone: str,
+    message_text: str,
+    message_id: str | None = None
+) -> dict:
+    """
+    Guarda el envío en el outbox y despierta al dispatcher.
+    """
+    now = datetime.utcnow()
+    entry = {
+        "id": str(uuid.uuid4()),
+        "agency_id": agency_id,
+        "to_phone": to_phone,
+        "message_text": message_text,
+        "message_id": message_id,
+        "status": OutboxStatus.PENDING,
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now
+    }
+    await outbox_collection.insert_one(entry)
+    if message_id:
+        await messages_collection.update_one(
+            {"id": message_id},
+            {"$set": {"delivery_status": "queued"}}
+        )
+    outbox_dispatcher.wake()
+    return entry
+
+
+class OutboxDispatcher:
+    """
+    Vacía el outbox respetando un token bucket por `phone_number_id`,
+    reintenta con backoff exponencial y deja el estado de entrega en el
+    documento del mensaje.
+
+    Cada envío se reclama con un lease (`locked_until`), así varios
+    procesos pueden compartir el mismo outbox.
+    """
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._buckets: dict[str, TokenBucket] = {}
+        self._semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._in_flight: set[asyncio.Task] = set()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox-dispatcher")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    def _bucket(self, phone_number_id: str) -> TokenBucket:
+        bucket = self._buckets.get(phone_number_id)
+        if bucket is None:
+            bucket = TokenBucket(OUTBOX_SEND_RATE, OUTBOX_SEND_BURST)
+            self._buckets[phone_number_id] = bucket
+        return bucket
+
+    async def _claim(self) -> dict | None:
+        now = datetime.utcnow()
+        return await outbox_collection.find_one_and_update(
+            {
+                "$or": [
+                    {"status": OutboxStatus.PENDING, "next_attempt_at": {"$lte": now}},
+                    {"status": OutboxStatus.SENDING, "locked_until": {"$lte": now}}
+                ]
+            },
+            {"$set": {
+                "status": OutboxStatus.SENDING,
+                "locked_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+            }, "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                claimed = 0
+                while True:
+                    await self._semaphore.acquire()
+                    try:
+                        entry = await self._claim()
+                    except BaseException:
+                        self._semaphore.release()
+                        raise
+                    if not entry:
+                        self._semaphore.release()
+                        break
+                    claimed += 1
+                    task = asyncio.create_task(self._deliver(entry))
+                    self._in_flight.add(task)
+                    task.add_done_callback(self._in_flight.discard)
+                if not claimed:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error in outbox dispatcher: {e}")
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    async def _send(self, entry: dict) -> str | None:
+        credentials = await whatsapp_client.get_credentials(entry["agency_id"])
+        if not credentials:
+            raise ValueError("WhatsApp credentials not configured")
+        access_token, phone_number_id = credentials
+
+        await self._bucket(phone_number_id).acquire()
+        try:
+            response = await whatsapp_client.send_text(
+                access_token,
+                phone_number_id,
+                entry["to_phone"],
+                entry["message_text"]
+            )
+        except httpx.TransportError as e:
+            raise RetryableSendError(str(e)) from e
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableSendError(
+                f"Graph API {response.status_code}: {response.text[:200]}",
+                retry_after=_retry_after_seconds(response)
+            )
+        if response.status_code >= 400:
+            raise ValueError(f"Graph API {response.status_code}: {response.text[:200]}")
+
+        return _whatsapp_message_id(response)
+
+    async def _deliver(self, entry: dict) -> None:
+        try:
+            # `attempts` ya cuenta este lease; los leases vencidos también cuentan
+            if entry.get("attempts", 0) > OUTBOX_MAX_ATTEMPTS:
+                raise ValueError("lease expired on every attempt")
+            whatsapp_message_id = await self._send(entry)
+        except RetryableSendError as e:
+            await self._record_failure(entry, str(e), retryable=True, retry_after=e.retry_after)
+        except Exception as e:
+            await self._record_failure(entry, str(e), retryable=False)
+        else:
+            await self._record_success(entry, whatsapp_message_id)
+        finally:
+            self._semaphore.release()
+
+    async def _record_success(self, entry: dict, whatsapp_message_id: str | None) -> None:
+        now = datetime.utcnow()
+        self.sent += 1
+        await outbox_collection.update_one(
+            {"id": entry["id"]},
+            {"$set": {
+                "status": OutboxStatus.SENT,
+                "sent_at": now,
+                "whatsapp_message_id": whatsapp_message_id
+            }, "$unset": {"locked_until": ""}}
+        )
+        if entry.get("message_id"):
+            await messages_collection.update_one(
+                {"id": entry["message_id"]},
+                {"$set": {
+                    "delivery_status": "sent",
+                    "whatsapp_message_id": whatsapp_message_id,
+                    "sent_at": now
+                }, "$unset": {"delivery_error": ""}}
+            )
+
+    async def _record_failure(self, entry: dict, error: str, retryable: bool,
+                              retry_after: float | None = None) -> None:
+        attempts = entry.get("attempts", 0)
+        give_up = not retryable or attempts >= OUTBOX_MAX_ATTEMPTS
+        if give_up:
+            self.failed += 1
+            print(f"Error sending WhatsApp (outbox {entry['id']}): {error}")
+        else:
+            self.retried += 1
+
+        update = {
+            "status": OutboxStatus.FAILED if give_up else OutboxStatus.PENDING,
+            "last_error": error
+        }
+        if not give_up:
+            delay = retry_after if retry_after is not None else _backoff_seconds(attempts)
+            update["next_attempt_at"] = datetime.utcnow() + timedelta(seconds=delay)
+        await outbox_collection.update_one(
+            {"id": entry["id"]},
+            {"$set": update, "$unset": {"locked_until": ""}}
+        )
+        if entry.get("message_id"):
+            await messages_collection.update_one(
+                {"id": entry["message_id"]},
+                {"$set": {
+                    "delivery_status": "failed" if give_up else "retrying",
+                    "delivery_error": error
+                }}
+            )
+
+    async def stats(self) -> dict:
+        pending = await outbox_collection.count_documents(
+            {"status": {"$in": [OutboxStatus.PENDING, OutboxStatus.SENDING]}}
+        )
+        return {
+            "running": self._task is not None,
+            "pending": pending,
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+
+
+outbox_dispatcher = OutboxDispatcher()
@@ -0,0 +1,51 @@
+# services/recent_messages.py
+
+import os
+
+from database import conversations_collection, messages_collection
+
+
+# Mensajes que se guardan en `conversation.recent_messages`
+RECENT_MESSAGES_LIMIT = int(os.environ.get("RECENT_MESSAGES_LIMIT", "10"))
+
+
+def recent_entry(message: dict) -> dict:
+    return {
+        "id": message["id"],
+        "from_customer": message["from_customer"],
+        "message_text": message["message_text"],
+        "timestamp": message["timestamp"]
+    }
+
+
+def push_recent(message: dict) -> dict:
+    """
+    Fragmento `$push` que agrega el mensaje al buffer acotado de la
+    conversación; se combina con el update que ya se hace al guardar.
+    """
+    return {
+        "recent_messages": {
+            "$each": [recent_entry(message)],
+            "$slice": -RECENT_MESSAGES_LIMIT
+        }
+    }
+
+
+async def get_recent_messages(conversation_id: str) -> list[dict]:
+    """
+    Últimos mensajes de la conversación, del más viejo al más nuevo.
+    Las conversaciones anteriores al buffer se leen de `messages`.
+    """
+    conversation = await conversations_collection.find_one(
+        {"id": conversation_id},
+        {"_id": 0, "recent_messages": 1}
+    )
+    if conversation and "recent_messages" in conversation:
+        return conversation["recent_messages"]
+
+    conv_messages = await messages_collection.find(
+        {"conversation_id": conversation_id},
+        {"_id": 0}
+    ).sort("timestamp", -1).limit(RECENT_MESSAGES_LIMIT).to_list(RECENT_MESSAGES_LIMIT)
+    conv_messages.reverse()
+    return conv_messages
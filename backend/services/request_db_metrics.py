@@ -0,0 +1,208 @@
+# services/request_db_metrics.py
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from pymongo import monitoring
+
+
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "500"))
+# Formas de consulta que se guardan por request para el log de lentos
+MAX_SHAPES_PER_REQUEST = int(os.environ.get("SLOW_REQUEST_MAX_SHAPES", "50"))
+
+_FILTER_COMMANDS = {"find", "count", "distinct", "findAndModify", "aggregate", "delete", "update"}
+
+
+class RequestDbStats:
+    """
+    Comandos de Mongo de un request. Motor copia el contexto a sus hilos,
+    así que el objeto es compartido y se protege con un lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = 0
+        self.failed = 0
+        self.duration_ms = 0.0
+        self.shapes: dict[str, int] = {}
+
+    def record(self, shape: str | None, duration_ms: float, failed: bool) -> None:
+        with self._lock:
+            self.commands += 1
+            self.failed += int(failed)
+            self.duration_ms += duration_ms
+            if shape and (shape in self.shapes or len(self.shapes) < MAX_SHAPES_PER_REQUEST):
+                self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def absorb(self, other: "RequestDbStats") -> None:
+        with self._lock:
+            self.commands += other.commands
+            self.failed += other.failed
+            self.duration_ms += other.duration_ms
+            for shape, count in other.shapes.items():
+                if shape in self.shapes or len(self.shapes) < MAX_SHAPES_PER_REQUEST:
+                    self.shapes[shape] = self.shapes.get(shape, 0) + count
+
+
+_current: contextvars.ContextVar[RequestDbStats | None] = contextvars.ContextVar(
+    "request_db_stats", default=None
+)
+
+
+def _shape(value):
+    """
+    Reemplaza los valores por `?` y deja campos y operadores.
+    """
+    if isinstance(value, dict):
+        return {key: _shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shape(value[0])] if value and isinstance(value[0], dict) else "?"
+    return "?"
+
+
+def query_shape(command_name: str, command: dict) -> str:
+    collection = command.get(command_name)
+    query = None
+    if command_name in _FILTER_COMMANDS:
+        if command_name == "update":
+            query = (command.get("updates") or [{}])[0].get("q")
+        elif command_name == "delete":
+            query = (command.get("deletes") or [{}])[0].get("q")
+        elif command_name == "aggregate":
+            first_stage = (command.get("pipeline") or [{}])[0]
+            query = first_stage.get("$match")
+        else:
+            query = command.get("filter", command.get("query"))
+    shape = f"{command_name} {collection}"
+    if query:
+        shape += f" {_shape(query)}"
+    if command.get("sort"):
+        shape += f" sort={list(command['sort'].keys())}"
+    return shape
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """
+    Suma a las estadísticas del request actual cada comando que termina.
+    Los comandos fuera de un scope (ej. el dispatcher del outbox) se ignoran.
+    """
+
+    def __init__(self):
+        self._shapes: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if _current.get() is None:
+            return
+        with self._lock:
+            self._shapes[event.request_id] = query_shape(event.command_name, event.command)
+
+    def _finish(self, event, failed: bool):
+        stats = _current.get()
+        if stats is None:
+            return
+        with self._lock:
+            shape = self._shapes.pop(event.request_id, None)
+        stats.record(shape, event.duration_micros / 1000, failed)
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+
+mongo_command_metrics = CommandMetricsListener()
+
+
+def current_db_stats() -> RequestDbStats | None:
+    """
+    Estadísticas del scope actual, para quien escribe en nombre de otros
+    (el message writer).
+    """
+    return _current.get()
+
+
+@contextmanager
+def shared_db_scope(targets: list[RequestDbStats]) -> Iterator[None]:
+    """
+    Cuenta los comandos del bloque completos en cada scope de `targets`:
+    un batch del message writer lleva documentos de varios requests y cada
+    uno esperó el batch entero.
+    """
+    stats = RequestDbStats()
+    token = _current.set(stats)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        for target in targets:
+            target.absorb(stats)
+
+
+@contextmanager
+def db_scope(label: str, slow_ms: float = SLOW_REQUEST_MS) -> Iterator[RequestDbStats]:
+    """
+    Cuenta los comandos de Mongo del bloque y lo reporta si tarda más de
+    `slow_ms`. Lo usa el middleware por request y el pool del webhook por
+    trabajo, que corre fuera de cualquier request.
+    """
+    stats = RequestDbStats()
+    token = _current.set(stats)
+    started = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= slow_ms:
+            _log_slow(label, stats, elapsed_ms)
+
+
+def _log_slow(label: str, stats: RequestDbStats, elapsed_ms: float) -> None:
+    print(
+        f"Slow request {label}: "
+        f"{elapsed_ms:.0f} ms, {stats.commands} comandos Mongo "
+        f"({stats.duration_ms:.0f} ms, {stats.failed} fallidos)"
+    )
+    for shape, count in sorted(stats.shapes.items(), key=lambda item: -item[1]):
+        print(f"    {count}x {shape}")
+
+
+class MongoTimingMiddleware:
+    """
+    Middleware ASGI: abre las estadísticas de Mongo de cada request, las
+    manda en `Server-Timing` y reporta los requests más lentos que
+    `SLOW_REQUEST_MS` junto con sus formas de consulta.
+    """
+
+    def __init__(self, app, slow_request_ms: float = SLOW_REQUEST_MS):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        label = f"{scope.get('method')} {scope.get('path')}"
+        with db_scope(label, self.slow_request_ms) as stats:
+
+            async def send_with_timing(message):
+                if message["type"] == "http.response.start":
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    timing = (
+                        f'db;dur={stats.duration_ms:.1f};desc="{stats.commands} commands", '
+                        f'app;dur={elapsed_ms:.1f}'
+                    )
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", timing.encode("latin-1")))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_timing)
@@ -0,0 +1,122 @@
+# services/response_cache.py
+
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+from services.intent_matcher import intent_matcher
+
+
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "900"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+RESPONSE_CACHE_MAX_WORDS = int(os.environ.get("RESPONSE_CACHE_MAX_WORDS", "8"))
+
+# Solo se cachean preguntas frecuentes que no dependen del cliente (el
+# inventario y las promociones van en la versión del snapshot); saludos,
+# agradecimientos y referencias de día/hora ("¿abren el sábado?") pueden
+# acompañarlas sin volverlas contextuales.
+FAQ_INTENTS = frozenset({"hours", "location", "financing", "cars", "promotions"})
+_NEUTRAL_INTENTS = frozenset({"greeting", "thanks", "time_reference"})
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_message(text: str) -> str | None:
+    """
+    Forma normalizada de una pregunta para usarla como llave, o None si
+    el mensaje no debe cachearse (largo, o con números como fechas y horas).
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = _SPACES.sub(" ", _NON_WORD.sub(" ", text)).strip()
+    if not text or any(ch.isdigit() for ch in text):
+        return None
+    if len(text.split(" ")) > RESPONSE_CACHE_MAX_WORDS:
+        return None
+    return text
+
+
+def is_cacheable(message: str, history: list | None) -> bool:
+    """
+    True si la respuesta a `message` sirve para cualquier cliente: es una
+    pregunta frecuente (horario, ubicación, financiamiento, autos,
+    promociones) y no hay turnos
+    previos en la conversación. Así el prompt no lleva nada del cliente y
+    la respuesta no puede mencionarlo ni a mensajes anteriores.
+    `history` puede incluir el mensaje actual; sin historial conocido no
+    se cachea.
+    """
+    if history is None:
+        return False
+    previous = [
+        msg for msg in history
+        if not (msg.get("from_customer") and msg.get("message_text") == message)
+    ]
+    if previous:
+        return False
+    intents = intent_matcher.classify(message)
+    return bool(intents & FAQ_INTENTS) and intents <= FAQ_INTENTS | _NEUTRAL_INTENTS
+
+
+class ResponseCache:
+    """
+    Cache LRU con TTL de respuestas de la IA por agencia, solo para
+    preguntas frecuentes sin contexto (`is_cacheable`). La llave incluye
+    la versión del snapshot de la agencia, así un cambio de inventario,
+    promociones o prompt nunca sirve una respuesta vieja.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: dict[str, OrderedDict[tuple[int, str], tuple[float, str]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, agency_id: str, version: int, message: str, history: list | None) -> str | None:
+        if not is_cacheable(message, history):
+            return None
+        key = normalize_message(message)
+        if key is None:
+            return None
+        entries = self._entries.get(agency_id)
+        cached = entries.get((version, key)) if entries else None
+        if cached is None or cached[0] < time.monotonic():
+            if cached is not None:
+                entries.pop((version, key), None)
+            self.misses += 1
+            return None
+        entries.move_to_end((version, key))
+        self.hits += 1
+        return cached[1]
+
+    def set(self, agency_id: str, version: int, message: str, history: list | None, response: str) -> None:
+        if not is_cacheable(message, history):
+            return
+        key = normalize_message(message)
+        if key is None or not response:
+            return
+        entries = self._entries.setdefault(agency_id, OrderedDict())
+        entries[(version, key)] = (time.monotonic() + self.ttl, response)
+        entries.move_to_end((version, key))
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def flush(self, agency_id: str | None = None) -> None:
+        if agency_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(agency_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "entries": sum(len(entries) for entries in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+response_cache = ResponseCache()
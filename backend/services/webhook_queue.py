@@ -0,0 +1,134 @@
+# services/webhook_queue.py
+
+import asyncio
+import os
+import time
+import zlib
+from typing import Awaitable, Callable
+
+from services.request_db_metrics import db_scope
+
+
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "10"))
+
+
+Job = Callable[[], Awaitable[None]]
+
+
+class WebhookQueueFull(Exception):
+    pass
+
+
+class WebhookWorkerPool:
+    """
+    Pool de workers asyncio para procesar mensajes del webhook fuera
+    del request.
+
+    Cada worker tiene su propia cola; los trabajos se reparten por hash
+    de la llave de conversación, así los mensajes de una misma
+    conversación se procesan en orden y conversaciones distintas corren
+    en paralelo.
+    """
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self._queues: list[asyncio.Queue] = []
+        self._tasks: list[asyncio.Task] = []
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._queues = [
+            asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)
+        ]
+        self._tasks = [
+            asyncio.create_task(self._worker(queue), name=f"webhook-worker-{i}")
+            for i, queue in enumerate(self._queues)
+        ]
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+        """
+        Espera a que se vacíen las colas (hasta `timeout`) y detiene los workers.
+        """
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in self._queues)),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            print(f"Webhook pool: {self.depth()} mensajes sin procesar al apagar")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queues = []
+
+    def _queue_for(self, key: str) -> asyncio.Queue:
+        index = zlib.crc32(key.encode("utf-8")) % self.workers
+        return self._queues[index]
+
+    async def submit(self, key: str, job: Job) -> None:
+        """
+        Encola `job` en la cola asignada a `key`. Si el pool no está
+        corriendo, el trabajo se ejecuta inline. Nunca espera lugar en la
+        cola: si está llena lanza `WebhookQueueFull`.
+        """
+        if not self.running:
+            await job()
+            return
+        try:
+            self._queue_for(key).put_nowait((time.monotonic(), key, job))
+        except asyncio.QueueFull:
+            self._rejected += 1
+            raise WebhookQueueFull(f"webhook queue for {key} is full")
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            enqueued_at, key, job = await queue.get()
+            lag = time.monotonic() - enqueued_at
+            self._last_lag = lag
+            self._max_lag = max(self._max_lag, lag)
+            try:
+                # Corre fuera del request: se cuentan sus comandos de Mongo aparte
+                with db_scope(f"webhook job {key}"):
+                    await job()
+                self._processed += 1
+            except Exception as e:
+                self._failed += 1
+                print(f"Error processing queued webhook message: {e}")
+            finally:
+                queue.task_done()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "depth": self.depth(),
+            "depth_per_worker": [q.qsize() for q in self._queues],
+            "processed": self._processed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "last_lag_ms": round(self._last_lag * 1000, 2),
+            "max_lag_ms": round(self._max_lag * 1000, 2),
+        }
+
+
+webhook_pool = WebhookWorkerPool()
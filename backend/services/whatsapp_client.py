@@ -0,0 +1,112 @@
+# services/whatsapp_client.py
+
+import os
+
+import httpx
+
+from database import system_config_collection
+
+
+GRAPH_API_URL = os.environ.get("WHATSAPP_GRAPH_API_URL", "https://graph.facebook.com/v18.0")
+GRAPH_HTTP2 = os.environ.get("WHATSAPP_HTTP2", "true").lower() == "true"
+GRAPH_MAX_CONNECTIONS = int(os.environ.get("WHATSAPP_MAX_CONNECTIONS", "50"))
+GRAPH_MAX_KEEPALIVE = int(os.environ.get("WHATSAPP_MAX_KEEPALIVE", "20"))
+GRAPH_KEEPALIVE_EXPIRY = float(os.environ.get("WHATSAPP_KEEPALIVE_EXPIRY", "30"))
+GRAPH_TIMEOUT = float(os.environ.get("WHATSAPP_TIMEOUT", "15"))
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class WhatsAppGraphClient:
+    """
+    Cliente HTTP compartido para la Graph API de WhatsApp.
+
+    Un solo `httpx.AsyncClient` con keep-alive (y HTTP/2 si `h2` está
+    instalado) que abre y cierra el lifespan de FastAPI. Las credenciales
+    de cada agencia se cachean y se invalidan al editar la configuración.
+    """
+
+    def __init__(self):
+        self._client: httpx.AsyncClient | None = None
+        self._credentials: dict[str, tuple[str, str] | None] = {}
+
+    def _build_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=GRAPH_HTTP2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=GRAPH_MAX_CONNECTIONS,
+                max_keepalive_connections=GRAPH_MAX_KEEPALIVE,
+                keepalive_expiry=GRAPH_KEEPALIVE_EXPIRY
+            ),
+            timeout=GRAPH_TIMEOUT
+        )
+
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = self._build_client()
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Si no se arrancó con el lifespan (scripts, tests) se crea bajo demanda
+        if self._client is None:
+            self._client = self._build_client()
+        return self._client
+
+    async def get_credentials(self, agency_id: str) -> tuple[str, str] | None:
+        """
+        Regresa `(access_token, phone_number_id)` de la agencia, o None.
+        """
+        if agency_id in self._credentials:
+            return self._credentials[agency_id]
+
+        config = await system_config_collection.find_one(
+            {"agency_id": agency_id},
+            {"_id": 0, "whatsapp_access_token": 1, "whatsapp_phone_number_id": 1}
+        )
+        credentials = None
+        if config:
+            access_token = config.get("whatsapp_access_token")
+            phone_number_id = config.get("whatsapp_phone_number_id")
+            if access_token and phone_number_id:
+                credentials = (access_token, phone_number_id)
+
+        self._credentials[agency_id] = credentials
+        return credentials
+
+    def invalidate(self, agency_id: str | None = None) -> None:
+        if agency_id is None:
+            self._credentials.clear()
+        else:
+            self._credentials.pop(agency_id, None)
+
+    async def send_text(
+        self,
+        access_token: str,
+        phone_number_id: str,
+        to_phone: str,
+        message: str
+    ) -> httpx.Response:
+        return await self.client.post(
+            f"{GRAPH_API_URL}/{phone_number_id}/messages",
+            headers={"Authorization": f"Bearer {access_token}"},
+            json={
+                "messaging_product": "whatsapp",
+                "to": to_phone,
+                "type": "text",
+                "text": {"body": message}
+            }
+        )
+
+
+whatsapp_client = WhatsAppGraphClient()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# El backend se importa como en producción (`from services...`)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
@@ -0,0 +1,115 @@
+import pytest
+
+from services import circuit_breaker
+from services.circuit_breaker import (
+    BREAKER_MIN_CALLS,
+    BREAKER_OPEN_SECONDS,
+    BREAKER_SLOW_MS,
+    HEDGE_MAX_SECONDS,
+    HEDGE_MIN_SECONDS,
+    BreakerState,
+    LatencyCircuitBreaker,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", fake)
+    return fake
+
+
+def _fill(breaker, key, calls):
+    for latency, ok in calls:
+        breaker.record(key, latency, ok)
+
+
+@pytest.mark.parametrize("calls, expected", [
+    # Menos llamadas que el mínimo: nunca abre
+    ([(0.1, False)] * (BREAKER_MIN_CALLS - 1), BreakerState.CLOSED),
+    ([(0.1, True)] * BREAKER_MIN_CALLS, BreakerState.CLOSED),
+    ([(0.1, True), (0.1, False)] * (BREAKER_MIN_CALLS // 2), BreakerState.OPEN),
+    ([(BREAKER_SLOW_MS / 1000, True)] * BREAKER_MIN_CALLS, BreakerState.OPEN),
+])
+def test_opens_on_error_rate_or_p95_latency(clock, calls, expected):
+    breaker = LatencyCircuitBreaker()
+    _fill(breaker, "key", calls)
+    assert breaker._breaker("key").state == expected
+
+
+def test_open_breaker_short_circuits_then_allows_a_single_probe(clock):
+    breaker = LatencyCircuitBreaker()
+    _fill(breaker, "key", [(0.1, False)] * BREAKER_MIN_CALLS)
+
+    assert breaker.allow("key") is False
+    clock.now += BREAKER_OPEN_SECONDS
+    assert breaker.allow("key") is True
+    assert breaker._breaker("key").state == BreakerState.HALF_OPEN
+    assert breaker.allow("key") is False
+    assert breaker.stats()["key_0"]["short_circuited"] == 2
+
+
+@pytest.mark.parametrize("latency, ok, expected", [
+    (0.1, True, BreakerState.CLOSED),
+    (0.1, False, BreakerState.OPEN),
+    (BREAKER_SLOW_MS / 1000, True, BreakerState.OPEN),
+])
+def test_probe_result_decides_the_half_open_state(clock, latency, ok, expected):
+    breaker = LatencyCircuitBreaker()
+    _fill(breaker, "key", [(0.1, False)] * BREAKER_MIN_CALLS)
+    clock.now += BREAKER_OPEN_SECONDS
+    assert breaker.allow("key") is True
+
+    breaker.record("key", latency, ok)
+    assert breaker._breaker("key").state == expected
+
+
+def test_release_frees_the_probe_without_a_result(clock):
+    breaker = LatencyCircuitBreaker()
+    _fill(breaker, "key", [(0.1, False)] * BREAKER_MIN_CALLS)
+    clock.now += BREAKER_OPEN_SECONDS
+    assert breaker.allow("key") is True
+
+    breaker.release("key")
+    assert breaker._breaker("key").state == BreakerState.HALF_OPEN
+    assert breaker.allow("key") is True
+
+
+def test_keys_are_independent(clock):
+    breaker = LatencyCircuitBreaker()
+    _fill(breaker, "a", [(0.1, False)] * BREAKER_MIN_CALLS)
+    assert breaker.allow("a") is False
+    assert breaker.allow("b") is True
+
+
+@pytest.mark.parametrize("latency, expected", [
+    (0.5, HEDGE_MIN_SECONDS),
+    ((HEDGE_MIN_SECONDS + HEDGE_MAX_SECONDS) / 2, (HEDGE_MIN_SECONDS + HEDGE_MAX_SECONDS) / 2),
+    (HEDGE_MAX_SECONDS * 2, HEDGE_MAX_SECONDS),
+])
+def test_hedge_timeout_is_clamped_percentile(monkeypatch, latency, expected):
+    monkeypatch.setattr(circuit_breaker, "HEDGE_PERCENTILE", 95)
+    monkeypatch.setattr(circuit_breaker, "BREAKER_SLOW_MS", float("inf"))
+    breaker = LatencyCircuitBreaker()
+    _fill(breaker, "key", [(latency, True)] * BREAKER_MIN_CALLS)
+    assert breaker.hedge_timeout("key") == pytest.approx(expected)
+
+
+def test_hedge_timeout_needs_enough_samples_and_a_percentile(monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "HEDGE_PERCENTILE", 95)
+    breaker = LatencyCircuitBreaker()
+    _fill(breaker, "key", [(1.0, True)] * (BREAKER_MIN_CALLS - 1))
+    assert breaker.hedge_timeout("key") is None
+
+    breaker.record("key", 1.0, True)
+    assert breaker.hedge_timeout("key") is not None
+    monkeypatch.setattr(circuit_breaker, "HEDGE_PERCENTILE", 0)
+    assert breaker.hedge_timeout("key") is None
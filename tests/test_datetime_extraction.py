@@ -0,0 +1,69 @@
+from datetime import date, datetime, time
+
+import pytest
+
+from services.datetime_extraction import extract_date, extract_datetime, extract_time
+
+
+# Miércoles 14 de octubre de 2026, mediodía
+NOW = datetime(2026, 10, 14, 12, 0)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("hoy", date(2026, 10, 14)),
+    ("mañana", date(2026, 10, 15)),
+    ("pasado mañana", date(2026, 10, 16)),
+    ("el viernes", date(2026, 10, 16)),
+    # El mismo día de la semana es la semana siguiente
+    ("el miércoles", date(2026, 10, 21)),
+    ("el miercoles", date(2026, 10, 21)),
+    ("12 de mayo", date(2027, 5, 12)),
+    ("20 de octubre", date(2026, 10, 20)),
+    ("3 de marzo de 2027", date(2027, 3, 3)),
+    ("20/10", date(2026, 10, 20)),
+    ("20-10-26", date(2026, 10, 20)),
+    # "en la mañana" es parte del día, no una fecha
+    ("en la mañana", None),
+    ("31/02", None),
+    ("30 de febrero", None),
+    ("quiero información", None),
+])
+def test_extract_date(text, expected):
+    assert extract_date(text, NOW) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("10:30", time(10, 30)),
+    ("a las 4 pm", time(16, 0)),
+    ("4 p.m.", time(16, 0)),
+    ("12 am", time(0, 0)),
+    ("17 hrs", time(17, 0)),
+    ("mediodía", time(12, 0)),
+    ("a las 5", time(17, 0)),
+    # AFTERNOON_CUTOFF: sin am/pm, antes de las 9 es de la tarde
+    ("a las 8", time(20, 0)),
+    ("a las 9", time(9, 0)),
+    ("a las 7 de la mañana", time(7, 0)),
+    ("a las 7 de la noche", time(19, 0)),
+    ("25:00", None),
+    ("sin hora", None),
+])
+def test_extract_time(text, expected):
+    assert extract_time(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("mañana a las 4", (date(2026, 10, 15), time(16, 0))),
+    ("el viernes a las 10:30", (date(2026, 10, 16), time(10, 30))),
+    # Los números de la fecha no se leen como hora
+    ("12 de mayo a las 5 pm", (date(2027, 5, 12), time(17, 0))),
+    ("12 de mayo", (date(2027, 5, 12), None)),
+    ("20/10 10:30", (date(2026, 10, 20), time(10, 30))),
+    # Una fecha inválida tampoco alimenta la hora
+    ("31/02", (None, None)),
+    ("el 31/02 a las 10", (None, time(10, 0))),
+    ("viernes 31/02", (date(2026, 10, 16), None)),
+    ("mañana en la mañana a las 11", (date(2026, 10, 15), time(11, 0))),
+])
+def test_extract_datetime(text, expected):
+    assert extract_datetime(text, NOW) == expected
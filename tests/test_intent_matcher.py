@@ -0,0 +1,34 @@
+import pytest
+
+from services.intent_matcher import IntentMatcher, intent_matcher
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Hola", {"greeting"}),
+    ("quiero agendar una cita", {"visit", "appointment"}),
+    ("¿A qué hora abren?", {"time_reference", "hours"}),
+    ("¿Dónde están?", {"location"}),
+    ("qué autos tienen", {"cars"}),
+    ("promociones", {"promotions"}),
+    ("tienen financiamiento?", {"financing"}),
+    ("¿cuánto cuesta?", {"pricing"}),
+    ("gracias, ok", {"thanks"}),
+    ("voy mañana a visitarlos", {"visit", "time_reference", "appointment"}),
+    # Palabras completas: "ir" y "ok" no se activan dentro de otras
+    ("quiero inspirarme", set()),
+    ("tokens", set()),
+    ("cital", set()),
+    ("", set()),
+])
+def test_classify(text, expected):
+    assert intent_matcher.classify(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("agendo", True),
+    ("agendamos", True),
+    ("reagendar", False),
+])
+def test_prefix_keywords_match_whole_word_start(text, expected):
+    matcher = IntentMatcher({"appointment": ["agend*"]})
+    assert matcher.matches(text, "appointment") is expected
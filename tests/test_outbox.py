@@ -0,0 +1,64 @@
+import asyncio
+
+from services import outbox
+from services.outbox import OutboxDispatcher
+
+
+def test_claim_error_releases_the_semaphore(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_POLL_INTERVAL", 0)
+
+    async def scenario():
+        dispatcher = OutboxDispatcher()
+        calls = 0
+
+        async def failing_claim():
+            nonlocal calls
+            calls += 1
+            raise ConnectionError("mongo unavailable")
+
+        dispatcher._claim = failing_claim
+        await dispatcher.start()
+        for _ in range(1000):
+            if calls >= outbox.OUTBOX_CONCURRENCY * 3:
+                break
+            await asyncio.sleep(0)
+        await dispatcher.stop()
+        return calls, dispatcher._semaphore._value
+
+    calls, free_permits = asyncio.run(scenario())
+    assert calls >= outbox.OUTBOX_CONCURRENCY * 3
+    assert free_permits == outbox.OUTBOX_CONCURRENCY
+
+
+def test_claim_error_does_not_stop_later_deliveries(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_POLL_INTERVAL", 0)
+
+    async def scenario():
+        dispatcher = OutboxDispatcher()
+        delivered = []
+        queue = [ConnectionError("mongo unavailable")] * (outbox.OUTBOX_CONCURRENCY + 1)
+        queue.append({"id": "entry-1"})
+
+        async def claim():
+            if not queue:
+                return None
+            item = queue.pop(0)
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        async def deliver(entry):
+            delivered.append(entry["id"])
+            dispatcher._semaphore.release()
+
+        dispatcher._claim = claim
+        dispatcher._deliver = deliver
+        await dispatcher.start()
+        for _ in range(1000):
+            if delivered:
+                break
+            await asyncio.sleep(0)
+        await dispatcher.stop()
+        return delivered
+
+    assert asyncio.run(scenario()) == ["entry-1"]